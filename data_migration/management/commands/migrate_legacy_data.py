@@ -5,6 +5,7 @@ from django.core.management.base import BaseCommand, CommandError, make_option
 from django.utils import translation
 from django.conf import settings
 
+from data_migration.metrics import JsonLinesSink, PrometheusTextfileSink
 from data_migration.migration import Importer, Migrator
 
 import sys
@@ -30,6 +31,120 @@ class Command(BaseCommand):
             help='Print the corresponding Query for each migration.',
             dest='logquery',
             default=False),
+        make_option('--validate',
+            action='store_true',
+            help='Runs the queries and transformations without writing to '
+                 'the DB and reports failing rows.',
+            dest='validate',
+            default=False),
+        make_option('--sample',
+            metavar='N|P%',
+            help='Migrates only the first N rows or P percent of each '
+                 'migration without committing and prints the estimated '
+                 'runtime for all rows.',
+            dest='sample',
+            default=None),
+        make_option('--rediscover',
+            action='store_true',
+            help='Searches all apps for migrations instead of using the '
+                 'cached DATA_MIGRATION_MANIFEST.',
+            dest='rediscover',
+            default=False),
+        make_option('--only',
+            action='append',
+            metavar='MIGRATION|MODEL',
+            help='Migrates only the supplied migration (or the migration '
+                 'for the supplied model). Can be given multiple times.',
+            dest='only',
+            default=[]),
+        make_option('--with-upstream',
+            action='store_true',
+            help='Also migrates the dependencies of the --only migrations.',
+            dest='upstream',
+            default=False),
+        make_option('--with-downstream',
+            action='store_true',
+            help='Also migrates the migrations depending on the --only '
+                 'migrations.',
+            dest='downstream',
+            default=False),
+        make_option('--plan',
+            type='int',
+            metavar='WORKERS',
+            help='Prints the estimated schedule of the migrations for the '
+                 'supplied number of workers, based on the recorded '
+                 'durations, instead of migrating.',
+            dest='plan',
+            default=None),
+        make_option('--max-failures',
+            type='int',
+            metavar='N',
+            help='Puts up to N failing rows of each migration into quarantine '
+                 'instead of aborting. Use replay_quarantine to migrate them '
+                 'again.',
+            dest='max_failures',
+            default=None),
+        make_option('--snapshot',
+            metavar='DIR',
+            help='Stores the result of each query in DIR and reads it from '
+                 'there on later runs until the query changes.',
+            dest='snapshot_dir',
+            default=None),
+        make_option('--track-memory',
+            action='store_true',
+            help='Records the memory usage of each migration and its '
+                 'relation caches and prints it at the end.',
+            dest='track_memory',
+            default=False),
+        make_option('--memory-report',
+            metavar='FILE',
+            help='Writes the recorded memory usage as JSON to FILE after each '
+                 'migration. Implies --track-memory.',
+            dest='memory_report',
+            default=None),
+        make_option('--count-queries',
+            action='store_true',
+            help='Counts the queries each migration issues on the Django '
+                 'database and warns about migrations issuing too many '
+                 'queries per row.',
+            dest='count_queries',
+            default=False),
+        make_option('--mute-signals',
+            action='store_true',
+            help='Does not call the receivers of the model signals (e.g. '
+                 'post_save) while migrating.',
+            dest='mute_signals',
+            default=False),
+        make_option('--follow',
+            action='store_true',
+            help='Applies the rows, which have been changed in the legacy DB '
+                 'since the last run, until it is interrupted. Each batch is '
+                 'committed on its own. Requires --commit.',
+            dest='follow',
+            default=False),
+        make_option('--interval',
+            type='float',
+            metavar='SECONDS',
+            help='The number of seconds between two polls with --follow.',
+            dest='interval',
+            default=5.0),
+        make_option('--metrics-textfile',
+            metavar='FILE',
+            help='Writes the metrics of the run (e.g. rows read and written) '
+                 'in the Prometheus text format to FILE.',
+            dest='metrics_textfile',
+            default=None),
+        make_option('--metrics-jsonl',
+            metavar='FILE',
+            help='Appends the metrics of the run as JSON lines to FILE.',
+            dest='metrics_jsonl',
+            default=None),
+        make_option('--metrics-interval',
+            type='float',
+            metavar='SECONDS',
+            help='The number of seconds between two updates of the metrics.',
+            dest='metrics_interval',
+            default=10.0),
     )
 
     def handle(self, *args, **options):
@@ -38,12 +153,53 @@ class Command(BaseCommand):
         excluded_apps = options.get('excluded_apps', [])
 
         sys.stdout.write("Importing migrations ...\n")
-        Importer.import_all(excludes=excluded_apps)
+        Importer.import_all(excludes=excluded_apps,
+                            rediscover=options.get('rediscover', False))
+        sys.stdout.write("Found %d migrations in %.3fs\n" % (
+            len(Importer.migrations()), Importer.discovery_time))
+
+        if options.get('plan'):
+            Migrator.print_schedule(options['plan'])
+            return
+
+        metrics = []
+        if options.get('metrics_textfile'):
+            metrics.append(PrometheusTextfileSink(options['metrics_textfile']))
+        if options.get('metrics_jsonl'):
+            metrics.append(JsonLinesSink(options['metrics_jsonl']))
+        metrics_interval = options.get('metrics_interval', 10.0)
+
+        if options.get('follow'):
+            if not options.get('commit_changes'):
+                raise CommandError("--follow commits each batch, pass --commit")
+
+            sys.stdout.write("Following changes ...\n")
+            try:
+                Migrator.follow(interval=options.get('interval', 5.0),
+                                only=options.get('only', []),
+                                metrics=metrics,
+                                metrics_interval=metrics_interval)
+            except KeyboardInterrupt:
+                sys.stdout.write("Stopped following\n")
+            return
 
         sys.stdout.write("Running migrations ...\n")
         Migrator.migrate(
             commit=options.get('commit_changes', False),
-            log_queries=options.get('logquery', False)
+            log_queries=options.get('logquery', False),
+            validate=options.get('validate', False),
+            sample=options.get('sample', None),
+            only=options.get('only', []),
+            upstream=options.get('upstream', False),
+            downstream=options.get('downstream', False),
+            max_failures=options.get('max_failures', None),
+            snapshot_dir=options.get('snapshot_dir', None),
+            track_memory=options.get('track_memory', False),
+            memory_report=options.get('memory_report', None),
+            count_queries=options.get('count_queries', False),
+            mute_signals=options.get('mute_signals', False),
+            metrics=metrics,
+            metrics_interval=metrics_interval
         )
 
         sys.stdout.write("Done\n")
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from __future__ import print_function
+from django.core.management.base import BaseCommand, CommandError, make_option
+from django.utils import translation
+from django.conf import settings
+
+from data_migration.migration import Importer, Migrator
+
+import sys
+
+class Command(BaseCommand):
+    help = 'Migrates the rows, which have been put into quarantine, again'
+    can_import_settings = True
+
+    option_list = BaseCommand.option_list + (
+        make_option('--commit',
+            action='store_true',
+            help='Commits the Changes to DB if all rows are done right.',
+            dest='commit_changes',
+            default=False),
+        make_option('--exclude',
+            action='append',
+            metavar='APP',
+            help='Excludes the supplied app from beeing replayed.',
+            dest='excluded_apps',
+            default = []),
+    )
+
+    def handle(self, *args, **options):
+        translation.activate(settings.LANGUAGE_CODE)
+
+        sys.stdout.write("Importing migrations ...\n")
+        Importer.import_all(excludes=options.get('excluded_apps', []))
+
+        sys.stdout.write("Replaying quarantined rows ...\n")
+        Migrator.replay_quarantine(
+            commit=options.get('commit_changes', False))
+
+        sys.stdout.write("Done\n")
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from __future__ import print_function
+from django.core.management.base import BaseCommand, CommandError, make_option
+from django.utils import translation
+from django.conf import settings
+
+from data_migration.migration import Importer, Migrator
+
+import sys
+
+class Command(BaseCommand):
+    help = 'Compares the legacy data with the migrated data'
+    can_import_settings = True
+
+    option_list = BaseCommand.option_list + (
+        make_option('--exclude',
+            action='append',
+            metavar='APP',
+            help='Excludes the supplied app from beeing verified.',
+            dest='excluded_apps',
+            default = []),
+        make_option('--only',
+            action='append',
+            metavar='MIGRATION|MODEL',
+            help='Verifies only the supplied migration (or the migration '
+                 'for the supplied model). Can be given multiple times.',
+            dest='only',
+            default=[]),
+        make_option('--chunk-size',
+            type='int',
+            metavar='N',
+            help='The number of rows, which are compared at once.',
+            dest='chunk_size',
+            default=1000),
+    )
+
+    def handle(self, *args, **options):
+        translation.activate(settings.LANGUAGE_CODE)
+
+        sys.stdout.write("Importing migrations ...\n")
+        Importer.import_all(excludes=options.get('excluded_apps', []))
+
+        sys.stdout.write("Verifying migrations ...\n")
+        results = Migrator.verify(
+            only=options.get('only', []),
+            chunk_size=options.get('chunk_size', 1000))
+
+        if any(result['differences'] for result in results):
+            raise CommandError("The migrated data differs from the legacy data")
+
+        sys.stdout.write("Done\n")
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from .utils import RowEncoder
+
+import io
+import json
+import os
+import time
+
+class Metrics(object):
+    """
+    Collects the counters and gauges of a run and passes them to the supplied
+    sinks at most every `interval` seconds (and at the end of each migration).
+
+    Counters (`rows_read`, `rows_written`, `rows_skipped`, `rows_failed`) and
+    gauges (`batch_latency_seconds`, `lag_seconds`) are kept per migration.
+    `relation_cache_entries` and `current_migration` describe the whole run.
+    """
+
+    COUNTERS = ('rows_read', 'rows_written', 'rows_skipped', 'rows_failed')
+
+    def __init__(self, sinks, interval=10.0):
+        self.sinks = sinks
+        self.interval = interval
+        self.counters = dict( (name, {}) for name in self.COUNTERS )
+        self.gauges = {}
+        self.relation_cache_entries = 0
+        self.current_migration = None
+        self.written_at = None
+
+    def start(self, migration):
+        """sets the current migration"""
+        self.current_migration = str(migration)
+        for counter in self.counters.values():
+            counter.setdefault(self.current_migration, 0)
+        self.flush(force=True)
+
+    def increment(self, name, migration, value=1):
+        counter = self.counters[name]
+        counter[str(migration)] = counter.get(str(migration), 0) + value
+
+    def gauge(self, name, migration, value):
+        self.gauges.setdefault(name, {})[str(migration)] = value
+
+    def snapshot(self):
+        """returns the current values as a dict"""
+        return { 'timestamp': time.time(),
+                 'current_migration': self.current_migration,
+                 'relation_cache_entries': self.relation_cache_entries,
+                 'counters': self.counters, 'gauges': self.gauges }
+
+    def flush(self, force=False):
+        """writes the current values to the sinks, if `interval` has passed"""
+        now = time.time()
+        if not force and self.written_at is not None and \
+                now - self.written_at < self.interval:
+            return
+
+        self.written_at = now
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            sink.write(snapshot)
+
+    def close(self):
+        self.current_migration = None
+        self.flush(force=True)
+        for sink in self.sinks:
+            sink.close()
+
+
+class MetricsSink(object):
+    """
+    Baseclass for the receivers of the metrics of a run. `write` is called
+    with the dict returned by `Metrics.snapshot`.
+    """
+
+    def write(self, snapshot):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PrometheusTextfileSink(MetricsSink):
+    """
+    Writes the metrics in the text format of Prometheus to a file, which can
+    be collected by the textfile collector of the node exporter. The file is
+    replaced atomically on each write.
+    """
+
+    prefix = 'data_migration_'
+
+    def __init__(self, path):
+        self.path = path
+
+    def format(self, snapshot):
+        lines = []
+
+        def metric(name, kind, values):
+            name = self.prefix + name
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in values:
+                lines.append("%s%s %s" % (name, labels, value))
+
+        def label(migration):
+            escaped = migration.replace('\\', '\\\\').replace('"', '\\"')
+            return '{migration="%s"}' % escaped
+
+        for name, counter in sorted(snapshot['counters'].items()):
+            metric(name + '_total', 'counter', [ (label(migration), value)
+                for migration, value in sorted(counter.items()) ])
+
+        for name, gauge in sorted(snapshot['gauges'].items()):
+            metric(name, 'gauge', [ (label(migration), value)
+                for migration, value in sorted(gauge.items()) ])
+
+        metric('relation_cache_entries', 'gauge',
+               [ ('', snapshot['relation_cache_entries']) ])
+
+        if snapshot['current_migration'] is not None:
+            metric('current_migration', 'gauge',
+                   [ (label(snapshot['current_migration']), 1) ])
+
+        metric('last_update_timestamp_seconds', 'gauge',
+               [ ('', "%.3f" % snapshot['timestamp']) ])
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, snapshot):
+        with io.open(self.path + ".tmp", 'w', encoding='utf-8') as f:
+            f.write(self.format(snapshot))
+        os.rename(self.path + ".tmp", self.path)
+
+
+class JsonLinesSink(MetricsSink):
+    """Appends each snapshot of the metrics as a line of JSON to a file"""
+
+    def __init__(self, path):
+        self.file = io.open(path, 'a', encoding='utf-8')
+
+    def write(self, snapshot):
+        self.file.write(json.dumps(snapshot, cls=RowEncoder) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -3,20 +3,40 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from future.builtins import str
 
-from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
-from django.db.models import Model
-
-from .models import AppliedMigration
-from .utils import itersubclasses
+from django import VERSION as DJANGO_VERSION
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist, \
+    ValidationError
+from django.db import DatabaseError, connection as django_connection
+from django.db.models import AutoField, Model, signals as model_signals
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .metrics import Metrics
+from .models import AppliedMigration, MigrationRun, QuarantinedRow, SyncMarker
+from .snapshot import Snapshot, SnapshotConnection
+from .utils import RowEncoder, class_attributes, format_duration, iterate_in_background, \
+    BackgroundCall, MemoryTracker, QueryCounter, approximate_size, muted_signals, \
+    checksum, decode_row
+
+from contextlib import contextmanager
+
+from collections import deque
+from datetime import datetime
 
 import inspect
+import json
 import sys
 import inspect
+import math
+import multiprocessing
+import numbers
 import re
+import time
 
 def is_a(klass=None, search_attr=None, fk=False, m2m=False, o2o=False,
                 exclude=False, delimiter=';', skip_missing=False,
-                prefetch=True, assign_by_id=False):
+                prefetch=True, assign_by_id=False, pairs_query=None,
+                owner_attr=None, deferred=False):
     """
     Generates a uniform set of information out of the supplied data and does
     some validations. This function is used to build the `column_description`
@@ -31,6 +51,20 @@ def is_a(klass=None, search_attr=None, fk=False, m2m=False, o2o=False,
                 elements which will be represented by a ManyToMany-Reference
     :param delimiter: The character which separates multiple elements in a
                       `m2m`-column
+    :param pairs_query: An SQL-SELECT-query for a `m2m`-relation, which returns
+                        one row of (owner, related element) for each
+                        relation. The pairs are written to the through-table
+                        in bulk after all instances have been created and the
+                        column is not required in `query`.
+    :param owner_attr: The model attribute of the migrated model, which is
+                       matched by the first column of `pairs_query`. Defaults
+                       to the `search_attr` of the migration or the primary
+                       key.
+    :param deferred: The `fk`- or `o2o`-column is saved as NULL and resolved
+                     with bulk UPDATEs after all migrations have been
+                     processed. The related model doesn't have to be migrated
+                     before, which allows self-referencing or cyclic
+                     relations.
     :param o2o: The specified column in query includes a OneToOne-Reference
     :param exclude: The specified column should not be processed automatically,
                     but can be accessed in any hook which includes the
@@ -67,10 +101,19 @@ def is_a(klass=None, search_attr=None, fk=False, m2m=False, o2o=False,
             raise ImproperlyConfigured(
                     'assign_by_id is only allowed with prefetch=True')
 
+        if pairs_query and not m2m:
+            raise ImproperlyConfigured(
+                    'pairs_query is only allowed for m2m columns')
+
+        if deferred and m2m:
+            raise ImproperlyConfigured(
+                    'deferred is only allowed for fk and o2o columns')
+
     return { 'm2m': m2m, 'klass': klass, 'fk': fk, 'o2o': o2o,
              'attr': search_attr, 'exclude': exclude, 'delimiter': delimiter,
              'skip_missing': skip_missing, 'prefetch': prefetch,
-             'assign_by_id': assign_by_id
+             'assign_by_id': assign_by_id, 'pairs_query': pairs_query,
+             'owner_attr': owner_attr, 'deferred': deferred
             }
 
 
@@ -89,6 +132,10 @@ class Migration(object):
     #: in-depth description for this attribute.
     query = None
 
+    #: A `SharedSource`, whose query is used instead of `query`. Its rows are
+    #: read once for all migrations with the same `shared_source`.
+    shared_source = None
+
     #: This dict contains information about special columns returned by the
     #: query (ForeinKey-, OneToOne- and Many2Many-Relations) or if it should be
     #: excluded from automatic processing.
@@ -112,10 +159,213 @@ class Migration(object):
     #:             `True`
     search_attr = None
 
+    #: The number of rows which are fetched from the legacy DB at once.
+    batch_size = 1000
+
+    #: If set, the batch size is adapted after each batch, so that processing
+    #: a batch takes about this number of seconds. `batch_size` is used for
+    #: the first batch. This is not used for updating migrations.
+    target_batch_latency = None
+
+    #: If set, the batch size is limited, so that the rows of a batch take
+    #: about this number of bytes at most, based on the size of the fetched
+    #: rows.
+    max_batch_memory = None
+
+    #: The lower limit of the adapted batch size
+    min_batch_size = 10
+
+    #: The upper limit of the adapted batch size
+    max_batch_size = 100000
+
+    #: The number of batches which are read ahead from the legacy DB by
+    #: a background thread while the current batch is written. This limits
+    #: the memory used for buffering. `0` disables the background thread.
+    #:
+    #: :important: the connection returned by `open_db_connection` has to be
+    #:             usable from another thread (e.g. pass
+    #:             `check_same_thread=False` for sqlite3)
+    read_ahead = 0
+
+    #: If `True` (and `read_ahead` is enabled), `hook_before_transformation`
+    #: is called by the background thread, so it must not access the Django
+    #: database. This is not used for updating migrations.
+    transform_in_reader = False
+
+    #: The number of worker processes, which call `hook_before_transformation`
+    #: (or `hook_before_transformation_batch`) for the fetched batches, while
+    #: the relations are resolved and the instances are written by the main
+    #: process. Use this for CPU-heavy hooks, which must not access the Django
+    #: database. The migration has to be importable by the workers. The
+    #: workers are started before the query is executed, as forking a process
+    #: with running threads can deadlock it, so pending row counts of the
+    #: previous migrations are waited for first. `0` disables the worker
+    #: processes. This is not used for updating migrations.
+    transform_processes = 0
+
+    #: How the number of rows is determined for the progress output:
+    #:
+    #: * `'cursor'` uses `cursor.rowcount`, which is -1 for several drivers
+    #: * `'count'` issues a `SELECT COUNT(*)` that wraps `query` on a separate
+    #:   connection, in parallel with `query` itself
+    #: * `'auto'` issues the count query only if `cursor.rowcount` is unknown
+    #:   and `hook_row_count` is not overridden
+    #:
+    #: The count is cached for the rest of the run.
+    count_strategy = 'auto'
+
+    #: The number of failing rows, which are put into quarantine (the
+    #: `QuarantinedRow` model) instead of aborting the run. The run is aborted
+    #: as soon as more rows fail. `None` aborts on the first failing row.
+    #: Quarantined rows can be replayed with the `replay_quarantine` command.
+    max_failures = None
+
+    #: If `True`, the instances of each batch are written with a single
+    #: `bulk_create`. If the database rejects it, the batch is split until the
+    #: failing rows are isolated, so the remaining rows are still written in
+    #: bulk. This is not possible for migrations with m2m columns or a
+    #: `hook_after_save`, nor with deferred relations, unless the query returns
+    #: the primary keys (as `search_attr`) or the database returns them from
+    #: bulk inserts (PostgreSQL on Django 1.10+).
+    bulk_insert = False
+
+    #: A list of model fields, which are overwritten for existing instances.
+    #: If set, each batch is written with a single upsert statement (e.g.
+    #: `INSERT ... ON CONFLICT DO UPDATE`), where existing instances are found
+    #: by `search_attr`, instead of searching each row and calling
+    #: `hook_update_existing`. This requires `allow_updates` and is not
+    #: possible for migrations with m2m columns or a `hook_after_save`.
+    upsert_fields = None
+
+    #: If `True`, all instances of `model` are deleted and created again on
+    #: every run (e.g. for lookup tables), without searching for existing
+    #: instances. The instances are written with `bulk_create` if this is
+    #: possible (see `bulk_insert`). The primary keys of the instances should
+    #: be returned by `query`, so references to them stay valid.
+    full_refresh = False
+
+    #: A column returned by `query`, whose value increases whenever a row is
+    #: added or changed in the legacy DB (e.g. a sequence or a modification
+    #: timestamp). The highest value is stored after each run, so
+    #: `migrate_legacy_data --follow` can apply the rows changed since then.
+    #: A timestamp also allows to measure the lag of the migrated data.
+    change_marker = None
+
+    #: The number of changed rows, which are applied in a single transaction
+    #: by `migrate_legacy_data --follow`.
+    follow_batch_size = 100
+
+    #: The columns returned by `query`, which are compared with the fields of
+    #: the migrated instances by the `verify_legacy_data` command. By default
+    #: all columns, which are not described in `column_description` and have
+    #: a model field with the same name, are compared. Use this to leave out
+    #: columns, which are transformed by the hooks.
+    verify_columns = None
+
+    #: Model signals (e.g. `[post_save]`), whose receivers are not called while
+    #: this migration is migrated, or `True` for all model signals except
+    #: `pre_init` and `post_init`. Use `hook_after_muted_signals` to do the
+    #: work of the receivers in bulk.
+    mute_signals = None
+
+    #: A directory, where the result of `query` is stored locally on the first
+    #: run. Later runs read the rows from there instead of the legacy DB until
+    #: `query` changes. `None` disables snapshots.
+    snapshot_dir = None
+
+    #: If `True`, the migration is executed as a single
+    #: `INSERT INTO ... SELECT` on the Django database, where relations are
+    #: resolved with joins. This requires that the legacy tables can be
+    #: accessed by the Django database connection and is only possible for
+    #: migrations with plain, `fk` and `o2o` columns, that don't override
+    #: any row-level hooks. Fields with a callable default have to be returned
+    #: by `query`.
+    pushdown = False
+
+    #: If `True`, the memory usage of the migration and the size of each
+    #: relation cache it builds up are recorded in `memory_usage`. This slows
+    #: down the migration on Python 3, as `tracemalloc` is used.
+    track_memory = False
+
+    #: If `True`, the queries issued on the Django database are counted per
+    #: phase (relation lookups, saving, m2m relations and hooks) and recorded
+    #: in `query_counts`.
+    count_queries = False
+
+    #: A warning is printed, if `count_queries` is set and more queries per
+    #: row are issued on the Django database. Note that saving an instance
+    #: with a primary key takes two queries (UPDATE and INSERT).
+    max_queries_per_row = 4
+
     # lookup cache which decreases the number of issued SQL queries
     # dramatically by prefetching all related objects
     relation_cache = {}
 
+    # the models, whose relation caches can miss instances, which have been
+    # written after prefetching, e.g. by a previous migration of a shared scan
+    incomplete_caches = ()
+
+    # maps (klass, attr) to the primary keys of instances, which have been
+    # validated but not saved. This is shared by all migrations and only
+    # filled during a validation run.
+    validated_index = {}
+
+    # caches the row count of each query during a run
+    row_counts = {}
+
+    # the count query, which is currently running in the background
+    row_counter = None
+
+    # the number of rows put into quarantine during the current migration
+    failures = 0
+
+    # the rows put into quarantine during the current run
+    quarantined = []
+
+    # maps the name of each migration to its recorded memory usage
+    memory_usage = {}
+
+    # the entry count and size of each relation cache built up during the
+    # current migration
+    cache_usage = {}
+
+    # maps the name of each migration to its number of queries per phase
+    query_counts = {}
+
+    # the QueryCounter of the current migration
+    query_counter = None
+
+    # the adapted batch size of the current migration
+    current_batch_size = None
+
+    # the (limit, percentage) tuple of the sample, while the migration is
+    # sampled, see `limit_sample`
+    sample_size = None
+
+    # only this number of rows is read, while the migration is sampled
+    row_limit = None
+
+    # the number of rows of `query` according to `hook_row_count`, while the
+    # migration is sampled
+    sampled_total = None
+
+    # the number of rows processed by the current migration
+    processed_rows = 0
+
+    # the worker processes of the current migration, see `transform_processes`
+    transform_pool = None
+
+    # maps the name of each migration to the sizes of its processed batches,
+    # if the batch size is adapted
+    batch_sizes = {}
+
+    # maps (migration, column) to a list of (primary key, value) pairs for
+    # the deferred relations, which have to be resolved at the end of a run
+    deferred_relations = {}
+
+    # the `Metrics` of the current run, if they are exported
+    metrics = None
+
     #########
     # Hooks #
     #########
@@ -163,6 +413,49 @@ class Migration(object):
         pass
 
 
+    @classmethod
+    def hook_before_transformation_batch(self, rows):
+        """Is called with each batch of rows instead of
+        `hook_before_transformation`, if it is overridden.
+
+        Here you can transform whole columns at once, e.g. with the NumPy
+        arrays returned by `data_migration.utils.columnar`, or do a single
+        external lookup for the batch. If it raises, every row of the batch
+        is treated as failing.
+
+        :param rows: the list of dicts which represent the rows of the batch
+        """
+        for row in rows:
+            self.hook_before_transformation(row)
+
+
+    @classmethod
+    def hook_before_save_batch(self, instances, rows):
+        """Is called with each batch of instances instead of
+        `hook_before_save`, if it is overridden.
+
+        To prevent some of the instances from being saved, return a list with
+        a boolean for each instance, where `False` skips the instance.
+
+        :param instances: the list of migrating instances
+        :param rows: the list of rows, where each instance has been created from
+        """
+        return [ self.hook_before_save(instance, row) != False
+                    for instance, row in zip(instances, rows) ]
+
+
+    @classmethod
+    def hook_after_save_batch(self, instances, rows):
+        """Is called with each batch of saved instances instead of
+        `hook_after_save`, if it is overridden.
+
+        :param instances: the list of saved instances
+        :param rows: the list of rows, where each instance has been created from
+        """
+        for instance, row in zip(instances, rows):
+            self.hook_after_save(instance, row)
+
+
     @classmethod
     def hook_update_existing(self, instance, row):
         """Is called for each existing instance when `allow_updates` is True
@@ -196,6 +489,17 @@ class Migration(object):
         pass
 
 
+    @classmethod
+    def hook_after_muted_signals(self):
+        """Is called after the migration has been processed with
+        `mute_signals`, when the receivers are connected again
+
+        Here you can do the work of the muted receivers in bulk, e.g. update
+        a search index for all migrated instances at once.
+        """
+        pass
+
+
     @classmethod
     def hook_row_count(self, connection, cursor):
         """Is called for getting the number of elements returned by ``query``
@@ -207,7 +511,13 @@ class Migration(object):
         ``connection`` parameter).
 
         It should return a numeric value which is displayed when migrating.
+        By default the value is determined based on `count_strategy`. If it
+        is not known yet, -1 is returned and the value is updated as soon as
+        the count query has returned.
         """
+        if self.row_counter is not None:
+            return self.counted_rows(-1)
+
         return cursor.rowcount
 
 
@@ -215,13 +525,17 @@ class Migration(object):
     def hook_error_creating_instance(self, exception, row):
         """Is called in case of an error on creating instances from the query
 
-        It produces some debug output and reraises the exception
+        It produces some debug output and reraises the exception. If
+        `max_failures` is set, the row is put into quarantine instead.
         """
         sys.stderr.write(
             "Error: The following row produces an error on instance creation:\n")
         sys.stderr.write("%s\n" % row)
 
-        raise exception
+        if self.max_failures is None:
+            raise exception
+
+        self.quarantine_row(exception, row)
 
 
     ###################
@@ -239,271 +553,2354 @@ class Migration(object):
         print("Migrating %s" % self)
 
         self.check_migration() # check the configuration of the Migration
-        connection = self.open_db_connection()
-
-        cursor = connection.cursor()
-        cursor.execute(self.query)
-        fields = [ row[0] for row in cursor.description ]
 
-        if check is None:
-            # update existing migrations
-            self.process_cursor_for_update(connection, cursor, fields)
+        started = time.time()
+        self.failures = 0
+        self.processed_rows = 0
+        self.cache_usage = {}
+        tracker = MemoryTracker() if self.track_memory else None
 
-        else:
-            # do the normal migration method
-            self.process_cursor(connection, cursor, fields)
+        usage = None
+        try:
+            # rows changed while migrating are applied again when following
+            marker = self.current_change_marker() if self.change_marker else None
+            counter = self.query_counter = \
+                QueryCounter(django_connection).start() if self.count_queries else None
 
-            AppliedMigration.objects.create(classname=str(self))
+            try:
+                rows = self.write_rows(check)
+            finally:
+                if counter is not None:
+                    counter.stop()
+                    self.query_counter = None
 
+            if self.mute_signals:
+                self.hook_after_muted_signals()
 
-    @classmethod
-    def open_db_connection(self):
-        raise ImproperlyConfigured(
-            "You have to supply a suitable db connection for your DB: %s" % self)
+            if check is not None:
+                AppliedMigration.objects.get_or_create(classname=str(self))
 
+            if marker is not None:
+                self.store_change_marker(marker)
 
-    @classmethod
-    def process_cursor(self, connection, cursor, fields):
-        total = self.hook_row_count(connection, cursor)
-        current = 0
+            if counter is not None:
+                self.record_query_counts(counter, rows)
 
-        self.hook_before_all()
+            # the history is used for scheduling the migrations
+            MigrationRun.objects.create(classname=str(self), rows=rows,
+                                        duration=time.time() - started)
+        finally:
+            # tracemalloc must not keep tracing after a failing migration
+            if tracker is not None:
+                usage = tracker.stop()
 
-        for row in cursor.fetchall():
+        if usage is not None:
+            usage['relation_caches'] = self.cache_usage
+            Migration.memory_usage[str(self)] = usage
 
-            current += 1
-            sys.stdout.write("\rMigrating element %d/%d" % (current, total))
-            sys.stdout.flush()
 
-            self.create_instance_from_row(row)
+    @classmethod
+    def write_rows(self, check):
+        """
+        writes the rows of `query` to the Django DB the way the configuration
+        of this migration requires, i.e. by `pushdown`, by updating the
+        existing instances or by the normal migration method. This is shared
+        by `migrate` and `sample`.
 
-        self.hook_after_all()
-        print("")
+        :param check: the result of `migration_required`
 
+        returns the number of processed rows
+        """
+        # the receivers of the muted signals are disconnected temporarily
+        with muted_signals(self.muted_signals()):
+            if self.full_refresh:
+                self.clear_target()
 
-    @classmethod
-    def process_cursor_for_update(self, connection, cursor, fields):
-        total = self.hook_row_count(connection, cursor)
-        created = 0
-        existing = 0
+            if self.pushdown:
+                # let the target DB do all the work
+                rows = self.process_pushdown()
+                self.record_metric('rows_read', rows)
+                self.record_metric('rows_written', rows)
+                return rows
 
-        for row in cursor.fetchall():
+            if check is None and not self.upsert_fields:
+                # update existing migrations
+                connection = self.open_source_connection()
+                cursor = self.execute_query(connection)
+                fields = [ row[0] for row in cursor.description ]
 
-            # search for an existing instance
-            desc = is_a(self.model, search_attr=self.search_attr,
-                        fk=True, skip_missing=True)
-            element = self.get_object(desc, row[self.search_attr])
+                return self.process_cursor_for_update(connection, cursor, fields)
 
-            if element is not None:
-                existing += 1
-            else:
-                created += 1
+            # do the normal migration method, the workers are started before
+            # the count query and the read ahead threads
+            with self.transform_workers():
+                connection = self.open_source_connection()
+                cursor = self.execute_query(connection)
+                fields = [ row[0] for row in cursor.description ]
 
-            sys.stdout.write(
-                "\rSearch for missing Instances (exist/created/total):  %d/%d/%d" % (
-                    existing, created, total))
-            sys.stdout.flush()
+                return self.process_cursor(connection, cursor, fields)
 
-            if element is not None:
-                self.hook_update_existing(element, row)
-                continue
 
-            self.create_instance_from_row(row)
+    @classmethod
+    def muted_signals(self):
+        """
+        returns the signals, which are muted according to `mute_signals`.
+        `pre_init` and `post_init` are never muted by `True`, as Django uses
+        them internally, e.g. for `GenericForeignKey` and `ImageField`.
+        """
+        if self.mute_signals is True:
+            return [ model_signals.pre_save, model_signals.post_save,
+                     model_signals.pre_delete, model_signals.post_delete,
+                     model_signals.m2m_changed ]
 
-        print("")
+        return list(self.mute_signals or [])
 
 
     @classmethod
-    def create_instance_from_row(self, row):
+    @contextmanager
+    def query_phase(self, name):
         """
-        utility method that creates the suitable instance from row and calls
-        the required hook methods.
+        attributes the queries issued on the Django database in this context
+        to the phase `name`, if `count_queries` is set
         """
-        def create(row):
-            self.hook_before_transformation(row)
+        if self.query_counter is None:
+            yield
+        else:
+            with self.query_counter.phase(name):
+                yield
 
-            constructor_data, m2ms = self.transform_row_dataset(row)
-            instance = self.model(**constructor_data)
 
-            before_save_success = self.hook_before_save(instance, row)
-            if before_save_success == False:
-                sys.stdout.write("Skipping: before_save returned False")
-                return
+    @classmethod
+    def record_query_counts(self, counter, rows):
+        """
+        stores the counted queries in `query_counts` and prints a warning, if
+        there are more than `max_queries_per_row`
+        """
+        culprits = {
+            'lookup': 'relation lookups (use prefetch=True)',
+            'm2m': 'm2m relations (use a pairs_query)',
+            'hooks': 'queries in the hooks',
+            'save': 'saving the instances (use bulk_insert)',
+        }
 
-            instance.save()
-            self.create_m2ms(instance, m2ms)
+        total = counter.total()
+        Migration.query_counts[str(self)] = {
+            'rows': rows, 'total': total, 'phases': dict(counter.counts) }
 
-            self.hook_after_save(instance, row)
+        if not rows or total <= self.max_queries_per_row * rows:
+            return
 
-        try:
-            create(row)
-        except Exception as e:
-            self.hook_error_creating_instance(e, row)
+        phase = max(counter.counts, key=lambda name: counter.counts[name])
+        sys.stderr.write(
+            "Warning: %s has issued %.1f queries per row, most of them for "
+            "%s\n" % (self, float(total) / rows, culprits.get(phase, phase)))
 
 
     @classmethod
-    def transform_row_dataset(self, datarow):
-        """transforms the supplied row and evaluates columns of different types
+    def validate(self):
+        """method that is called to validate this migration without writing
 
-        returns the dict where columns which FKs or Data has been updated with
-        real instances
-        """
-        constructor_data = {}
-        m2ms = {}
+        The query is executed and every row is passed through
+        `hook_before_transformation`, `transform_row_dataset`, the model
+        constructor and `hook_before_save`, but nothing is saved. Failing
+        rows are reported to stderr.
 
-        for fieldname, data in datarow.items():
-            if fieldname in self.column_description:
-                desc = self.column_description[fieldname]
+        returns the number of failing rows
+        """
+        print("Validating %s" % self)
 
-                if desc['exclude']:
-                    continue
+        self.check_migration()
+        connection = self.open_source_connection()
 
-                elif desc['fk'] or desc['o2o']:
-                    instance = self.get_object(desc, data)
-                    if desc['assign_by_id']:
-                        fieldname += "_id"
+        cursor = self.execute_query(connection)
 
-                    constructor_data[fieldname] = instance
+        total = self.hook_row_count(connection, cursor)
+        current = 0
+        failures = []
 
-                elif desc['m2m']:
-                    if data is None:
-                        continue
+        def report(e, row):
+            failures.append(row)
+            sys.stderr.write("\nError: %s in the following row: %s: %s\n%s\n" % (
+                    self, e.__class__.__name__, e, row))
 
-                    parts = data.split(desc['delimiter'])
-                    objects = []
+        for rows in self.iterate_batches(cursor):
 
-                    for part in parts:
-                        element = self.get_object(desc, part)
-                        if element is None:
-                            continue
-                        objects.append(element)
-                    m2ms[fieldname] = objects
+            current += len(rows)
+            total = self.counted_rows(total)
+            sys.stdout.write("\rValidating element %d/%d" % (current, total))
+            sys.stdout.flush()
 
-            else:
-                constructor_data[fieldname] = data
+            for instance, m2ms, row, original in self.build_batch(
+                    rows, on_error=report):
+                self.remember_validated(instance)
 
-        return (constructor_data, m2ms,)
+        print("")
+        return len(failures)
 
 
     @classmethod
-    def get_object(self, desc, value):
-        klass = desc['klass']
-        attr  = desc['attr']
+    def build_instance(self, row, transformed=False, before_save=True):
+        """
+        does everything `create_instance_from_row` does before writing to the
+        DB. Returns a tuple of the unsaved instance (None if `hook_before_save`
+        has returned False) and the related objects for the m2m fields.
 
-        try:
-            if desc['prefetch']:
+        :param transformed: `hook_before_transformation` has already been
+                            called for this row
+        :param before_save: call `hook_before_save`
+        """
+        if not transformed:
+            with self.query_phase('hooks'):
+                self.hook_before_transformation(row)
 
-                # build up relation cache
-                if klass not in self.relation_cache:
-                    self.buildup_relation_cache(klass, attr, value,
-                                                desc['assign_by_id'])
+        with self.query_phase('lookup'):
+            constructor_data, m2ms = self.transform_row_dataset(row)
+        instance = self.model(**constructor_data)
 
-                # get the instance out of relation cache
-                inst = self.relation_cache[klass].get(value, None)
-                if inst:
-                    return inst
+        if before_save:
+            with self.query_phase('hooks'):
+                if self.hook_before_save(instance, row) == False:
+                    return (None, m2ms)
 
-                raise ObjectDoesNotExist(
-                    "%s matching query (%s=%s) does not exist in relation cache." % (
-                        klass.__name__, attr, value))
+        return (instance, m2ms)
 
-            else:
-                # get the related object out of the DB
-                return klass.objects.get(**{ attr: value })
 
-        except ObjectDoesNotExist as e:
-            if desc['skip_missing']:
-                return None
-            else:
-                raise
+    @classmethod
+    def build_batch(self, rows, transformed=False, on_error=None,
+                    originals=None):
+        """
+        does everything `build_instance` does for a whole batch of rows and
+        calls the batch hooks, if they are overridden. Failing rows are passed
+        to `on_error` (`hook_error_creating_instance` by default).
 
+        returns a list of (instance, m2ms, row, original) tuples for the
+        instances, which should be saved. `original` is a copy of the
+        untransformed row, if `max_failures` is set, and `row` otherwise.
 
-    @classmethod
-    def buildup_relation_cache(self, klass, attr, value, assign_by_id):
-        """this builds up the relation cache for the supplied supplied class
+        :param originals: the untransformed copies of already transformed
+                          rows, see `transform_ahead`
         """
+        on_error = on_error or self.hook_error_creating_instance
+        before_save_batch = self.overrides('hook_before_save_batch')
+
+        if originals is None:
+            originals = [ row.row if isinstance(row, TransformationFailure)
+                            else row for row in rows ]
+            if self.max_failures is not None:
+                originals = [ dict(row) for row in originals ]
+
+        if not transformed:
+            rows = self.transform_batch(rows)
+
+        entries = []
+        for row, original in zip(rows, originals):
+            if isinstance(row, TransformationFailure):
+                on_error(row.exception, original)
+                continue
 
-        # we have to use the right type as the relation_cache key
-        # because the attr could be in the wrong type when it comes from
-        # the sql query
-        type_of_attr = type(value)
+            try:
+                instance, m2ms = self.build_instance(
+                    row, transformed=True, before_save=not before_save_batch)
+            except Exception as e:
+                on_error(e, original)
+                continue
 
-        if assign_by_id:
-            # get a mapping from attr to pk which is more memory
-            # efficient as full object construction
-            cache = dict(
-                ( type_of_attr(left), right )
-                    for left, right in
-                        klass.objects.all().values_list(attr, 'pk')
-            )
+            if instance is not None:
+                entries.append((instance, m2ms, row, original))
+            else:
+                self.record_metric('rows_skipped')
 
-        else:
-            # get a mapping with full objects
-            cache = dict(
-                ( type_of_attr(inst.__getattribute__(attr)), inst )
-                    for inst in klass.objects.all()
-            )
+        if before_save_batch and entries:
+            try:
+                with self.query_phase('hooks'):
+                    flags = self.hook_before_save_batch(
+                        [ e[0] for e in entries ], [ e[2] for e in entries ])
+            except Exception as e:
+                for entry in entries:
+                    on_error(e, entry[3])
+                return []
 
-        self.relation_cache[klass] = cache
+            if flags is not None:
+                kept = [ entry for entry, flag in zip(entries, flags)
+                            if flag != False ]
+                self.record_metric('rows_skipped', len(entries) - len(kept))
+                entries = kept
+
+        return entries
 
 
     @classmethod
-    def cleanup_relation_cache(self):
+    def transform_batch(self, rows):
         """
-        This deletes the relation cache as it is a class-level variable which
-        is not garbage collected otherwise. Not cleaning up this cache after
-        usage can lead to serious memory usage.
+        calls `hook_before_transformation_batch` (or
+        `hook_before_transformation` for each row) on the supplied rows.
+
+        returns the rows, where failing rows are replaced by
+        a `TransformationFailure`
         """
-        self.relation_cache = {}
+        if not self.overrides('hook_before_transformation_batch'):
+            return [ self.transform_in_advance(row) for row in rows ]
 
+        try:
+            with self.query_phase('hooks'):
+                self.hook_before_transformation_batch(rows)
+        except Exception as e:
+            # there is no way to tell which row has failed
+            return [ TransformationFailure(e, row) for row in rows ]
 
-    @classmethod
-    def create_m2ms(self, instance, m2ms):
-        for field, values in m2ms.items():
-            instance.__getattribute__(field).add(*values)
+        return rows
 
 
     @classmethod
-    def migration_required(self):
-        """checks if the migration has already been applied"""
-        try:
-            AppliedMigration.objects.get(classname=str(self))
+    def transform_ahead(self, rows):
+        """
+        transforms the supplied rows with `transform_batch` before they are
+        processed, e.g. by the background thread or a worker process.
 
-            if self.allow_updates:
-                return None
+        returns a tuple of the transformed rows and untransformed copies of
+        them, if `max_failures` is set (for the quarantine), or None
+        """
+        originals = None
+        if self.max_failures is not None:
+            originals = [ dict(row) for row in rows ]
 
-            return False
-        except AppliedMigration.DoesNotExist as e:
-            return True
+        return (self.transform_batch(rows), originals)
 
 
     @classmethod
-    def check_migration(self):
-
-        if not isinstance(self.column_description, dict):
-            raise ImproperlyConfigured(
-                    '%s: `column_description` has to be a dict' % self)
-
-        if self.allow_updates and self.search_attr is None:
-            raise ImproperlyConfigured(
-                    '%s: `allow_updates` forces you to set the `search_attr` on ' % self +
-                    'the Migration. to search for existing instances. Example: `username`')
-
-        if not isinstance(self.depends_on, list):
-            raise ImproperlyConfigured(
-                    '%s: `depends_on` has to be a list of classes' % self)
+    def uses_batch_hooks(self):
+        """checks if this migration overrides any of the batch hooks"""
+        return any(self.overrides(hook) for hook in (
+            'hook_before_transformation_batch', 'hook_before_save_batch',
+            'hook_after_save_batch'))
 
-        if not ( inspect.isclass(self.model) and issubclass(self.model, Model)):
-            raise ImproperlyConfigured(
-                    '%s: `model` has to be a model CLASS' % self)
 
-        if not re.search('SELECT', self.query, re.IGNORECASE|re.MULTILINE):
-            raise ImproperlyConfigured(
-                '%s: `query` has to be a string containing SELECT: %s' % (
-                    self, self.query))
+    @classmethod
+    def remember_validated(self, instance):
+        """
+        registers the unsaved instance in the `validated_index`, so that
+        migrations depending on this one can resolve their relations
+        """
+        for (klass, attr), index in Migration.validated_index.items():
+            if klass is self.model:
+                index[str(getattr(instance, attr))] = instance.pk
+
+
+    @classmethod
+    def sample(self, limit=None, percentage=None):
+        """method that is called to migrate only a sample of this migration
+
+        Only the first `limit` rows or `percentage` percent of all rows are
+        migrated, but they are written exactly the way `migrate` would write
+        them (see `write_rows`). Failing rows are handled like in a real run:
+        without `max_failures` the first failing row ends the sample of this
+        migration, which is rolled back and counted as failed, but the run
+        goes on with the next migration.
+
+        returns a dict with the measured throughput and the runtime that is
+        extrapolated for all rows returned by `query`, or None if the
+        migration is not required anymore
+        """
+        check = self.migration_required()
+        if check == False:
+            print("%s has already been migrated, skip it!" % self)
+            return None
+
+        print("Sampling %s" % self)
+
+        self.check_migration()
+        self.failures = 0
+        self.processed_rows = 0
+        started = time.time()
+
+        with class_attributes([ self ], sample_size=(limit, percentage),
+                              row_limit=None, sampled_total=-1):
+            try:
+                with savepoint():
+                    processed = self.write_rows(check)
+
+                    if self.mute_signals:
+                        self.hook_after_muted_signals()
+            except ImproperlyConfigured:
+                raise
+            except Exception as e:
+                sys.stderr.write("\nError: Sampling %s has failed: %s: %s\n" % (
+                    self, e.__class__.__name__, e))
+                processed = self.processed_rows
+                self.failures += 1
+
+            total = self.sampled_total
+
+        duration = time.time() - started
+
+        if total < 0:
+            total = self.wait_for_row_count()
+
+        return sample_result(self, total, processed, self.failures, duration)
+
+
+    @classmethod
+    def limit_sample(self, total):
+        """
+        sets `row_limit` according to `sample_size`, if the migration is
+        sampled. `total` is the number of rows returned by `hook_row_count`.
+        """
+        if self.sample_size is None:
+            return
+
+        limit, percentage = self.sample_size
+
+        if percentage is not None:
+            if total < 0:
+                total = self.wait_for_row_count()
+            if total < 0:
+                raise ImproperlyConfigured(
+                    '%s: sampling by percentage requires `hook_row_count` '
+                    'to return the real number of rows' % self)
+            limit = int(math.ceil(total * percentage / 100.0))
+
+        self.row_limit = limit
+        self.sampled_total = total
+
+
+    @classmethod
+    def source_query(self):
+        """returns `query` or the query of the `shared_source`"""
+        if self.shared_source is not None:
+            return self.shared_source.query
+        return self.query
+
+
+    @classmethod
+    def execute_query(self, connection):
+        """
+        executes `query` on the supplied connection and starts counting the
+        rows in the background according to `count_strategy`.
+
+        returns the cursor
+        """
+        self.row_counter = None
+        snapshot = isinstance(connection, SnapshotConnection)
+
+        if self.count_strategy == 'count' and not snapshot:
+            self.start_row_count()
+
+        cursor = connection.cursor()
+        cursor.execute(self.source_query())
+
+        # an overridden `hook_row_count` determines the count on its own
+        if self.count_strategy == 'auto' and cursor.rowcount < 0 and \
+                not self.overrides('hook_row_count'):
+            self.start_row_count()
+
+        return cursor
+
+
+    @classmethod
+    def start_row_count(self):
+        """counts the rows of `query` in a background thread"""
+        key = (str(self), self.source_query())
+
+        if key not in Migration.row_counts:
+            Migration.row_counts[key] = BackgroundCall(self.count_rows)
+
+        self.row_counter = Migration.row_counts[key]
+
+
+    @classmethod
+    def count_query(self):
+        """returns the query which is used for counting the rows of `query`"""
+        return "SELECT COUNT(*) AS row_count FROM (%s) counted" % (
+            self.source_query().strip().rstrip(';'))
+
+
+    @classmethod
+    def count_rows(self):
+        """counts the rows of `query` on a separate connection"""
+        connection = self.open_db_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(self.count_query())
+            row = cursor.fetchone()
+        finally:
+            connection.close()
+
+        if isinstance(row, dict):
+            return int(row['row_count'])
+        return int(row[0])
+
+
+    @classmethod
+    def counted_rows(self, total):
+        """
+        returns the result of the background count if `total` is unknown and
+        the count query has already returned
+        """
+        counter = self.row_counter
+
+        if total < 0 and counter is not None and counter.done():
+            if counter.exception is None:
+                return counter.value
+
+        return total
+
+
+    @classmethod
+    def wait_for_row_count(self):
+        """waits for the background count, returns -1 if there is none"""
+        if self.row_counter is None:
+            return -1
+
+        self.row_counter.result()
+        return self.counted_rows(-1)
+
+
+    @classmethod
+    def process_pushdown(self):
+        """
+        migrates all rows with a single `INSERT INTO ... SELECT` on the Django
+        database, which has to be able to access the legacy tables
+        """
+        cursor = django_connection.cursor()
+
+        if self.sample_size is not None:
+            cursor.execute(self.count_query())
+            self.limit_sample(int(cursor.fetchone()[0]))
+
+        sql, params = self.compile_pushdown()
+
+        self.hook_before_all()
+
+        # relations, which must not be missing, are checked first, because
+        # they would be NULL otherwise
+        for check, desc in self.compile_pushdown_checks():
+            cursor.execute(check)
+            missing = cursor.fetchone()[0]
+            if missing:
+                raise ObjectDoesNotExist(
+                    "%s: %d rows reference a missing %s" % (
+                        self, missing, desc['klass'].__name__))
+
+        cursor.execute(sql, params)
+        rows = cursor.rowcount
+        print("Migrated %d elements on the DB server" % rows)
+
+        self.create_m2m_pairs()
+
+        self.hook_after_all()
+        return rows
+
+
+    @classmethod
+    def pushdown_query(self):
+        """
+        returns `query` in a form that can be used as a subquery, limited to
+        `row_limit` rows while sampling
+        """
+        query = self.query.strip().rstrip(';')
+        if self.row_limit is not None:
+            query = "SELECT * FROM (%s) sampled LIMIT %d" % (query, self.row_limit)
+        return query
+
+
+    @classmethod
+    def pushdown_source(self):
+        """returns `pushdown_query` with escaped placeholders"""
+        return self.pushdown_query().replace('%', '%%')
+
+
+    @classmethod
+    def pushdown_fields(self):
+        """returns the names of the columns returned by `query`"""
+        cursor = django_connection.cursor()
+        cursor.execute("SELECT * FROM (%s) q WHERE 1 = 0" % (
+            self.query.strip().rstrip(';')))
+        return [ column[0] for column in cursor.description ]
+
+
+    @classmethod
+    def compile_pushdown(self):
+        """
+        compiles `query` and `column_description` into a single
+        `INSERT INTO ... SELECT` statement, where the relations are resolved
+        with joins.
+
+        returns a tuple of the SQL and its parameters
+        """
+        qn = django_connection.ops.quote_name
+        meta = self.model._meta
+
+        columns = []
+        values = []
+        joins = []
+        params = []
+        covered = set()
+
+        for i, name in enumerate(self.pushdown_fields()):
+            desc = self.column_description.get(name)
+
+            if desc is None:
+                field = meta.get_field(name)
+                values.append("q.%s" % qn(name))
+
+            elif desc['exclude'] or desc['m2m']:
+                continue
+
+            else:
+                field = meta.get_field(name)
+                related = desc['klass']._meta
+                alias = "r%d" % i
+
+                values.append("%s.%s" % (alias, qn(related.pk.column)))
+                joins.append("LEFT JOIN %s %s ON %s.%s = q.%s" % (
+                    qn(related.db_table), alias, alias,
+                    qn(related.get_field(desc['attr']).column), qn(name)))
+
+            columns.append(qn(field.column))
+            covered.add(field)
+
+        # fields which are not returned by the query get their default value
+        # (or the current date for auto_now_add) as Django would do on save
+        instance = self.model()
+        for field in meta.local_fields:
+            if field in covered or field is meta.pk:
+                continue
+
+            # it would be evaluated only once for all rows
+            if field.has_default() and callable(field.default):
+                raise ImproperlyConfigured(
+                    '%s: `pushdown` is not possible with the callable default '
+                    'of %s, return it from `query` instead' % (self, field.name))
+
+            columns.append(qn(field.column))
+            values.append("%s")
+            params.append(field.get_db_prep_save(
+                field.pre_save(instance, True), connection=django_connection))
+
+        sql = "INSERT INTO %s (%s) SELECT %s FROM (%s) q %s" % (
+            qn(meta.db_table), ", ".join(columns), ", ".join(values),
+            self.pushdown_source(), " ".join(joins))
+
+        return (sql, params)
+
+
+    @classmethod
+    def compile_pushdown_checks(self):
+        """
+        returns a list of (SQL, desc) tuples for each relation which must not
+        be missing. Each SQL counts the rows where the relation is missing.
+        """
+        qn = django_connection.ops.quote_name
+        checks = []
+
+        for name, desc in self.column_description.items():
+            if desc['exclude'] or desc['skip_missing'] or desc['m2m']:
+                continue
+
+            related = desc['klass']._meta
+            checks.append((
+                "SELECT COUNT(*) FROM (%s) q LEFT JOIN %s r ON r.%s = q.%s "
+                "WHERE q.%s IS NOT NULL AND r.%s IS NULL" % (
+                    self.pushdown_query(), qn(related.db_table),
+                    qn(related.get_field(desc['attr']).column), qn(name),
+                    qn(name), qn(related.pk.column)),
+                desc))
+
+        return checks
+
+
+    @classmethod
+    def check_pushdown(self):
+        """checks if this migration can be migrated by `pushdown`"""
+        if self.allow_updates:
+            raise ImproperlyConfigured(
+                '%s: `pushdown` is not possible with `allow_updates`' % self)
+
+        if any(desc['m2m'] and not desc['pairs_query']
+                for desc in self.column_description.values()):
+            raise ImproperlyConfigured(
+                '%s: `pushdown` is only possible with m2m columns, which '
+                'define a `pairs_query`' % self)
+
+        if self.deferred_columns():
+            raise ImproperlyConfigured(
+                '%s: `pushdown` is not possible with deferred relations' % self)
+
+        for hook in ('hook_before_transformation', 'hook_before_save',
+                     'hook_after_save', 'hook_before_transformation_batch',
+                     'hook_before_save_batch', 'hook_after_save_batch'):
+            if self.overrides(hook):
+                raise ImproperlyConfigured(
+                    '%s: `pushdown` is not possible with `%s`' % (self, hook))
+
+
+    @classmethod
+    def current_change_marker(self):
+        """
+        returns the highest value of `change_marker` in the legacy DB or in
+        the snapshot, if the rows are read from a snapshot
+        """
+        if self.snapshot_dir is not None and self.shared_source is None:
+            # the snapshot may be older than the legacy DB
+            connection = self.open_source_connection()
+            cursor = connection.cursor()
+            cursor.execute(self.source_query())
+            marker = None
+
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    return marker
+
+                for row in rows:
+                    value = row[self.change_marker]
+                    if value is not None and (marker is None or value > marker):
+                        marker = value
+
+        connection = self.open_db_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT MAX(q.%s) AS marker FROM (%s) q" % (
+                self.change_marker, self.source_query().strip().rstrip(';')))
+            row = cursor.fetchone()
+        finally:
+            connection.close()
+
+        return row['marker'] if isinstance(row, dict) else row[0]
+
+
+    @classmethod
+    def store_change_marker(self, value, keys=()):
+        """
+        stores the `change_marker` up to which the rows have been migrated
+        and the `search_attr` values of the rows with this marker, which have
+        been applied already
+        """
+        values = { 'value': self.quote_marker(value),
+                   'keys': json.dumps(sorted(keys)) }
+
+        # update_or_create needs Django >= 1.7
+        marker, created = SyncMarker.objects.get_or_create(
+            classname=str(self), defaults=values)
+        if not created:
+            marker.value, marker.keys = values['value'], values['keys']
+            marker.save()
+
+
+    @classmethod
+    def quote_marker(self, value):
+        """
+        returns the supplied value of `change_marker` as an SQL literal for
+        the legacy DB
+        """
+        if isinstance(value, numbers.Number) and not isinstance(value, bool):
+            return str(value)
+        return "'%s'" % str(value).replace("'", "''")
+
+
+    @classmethod
+    def follow_query(self, marker):
+        """
+        returns the query for the rows, which have been changed since the
+        supplied (quoted) marker, ordered by `change_marker`. The rows with
+        the marker itself are included, as further rows with the same marker
+        may have been committed later.
+        """
+        query = self.source_query().strip().rstrip(';')
+        if marker is None:
+            return "SELECT * FROM (%s) q ORDER BY q.%s" % (query, self.change_marker)
+
+        return "SELECT * FROM (%s) q WHERE q.%s >= %s ORDER BY q.%s" % (
+            query, self.change_marker, marker, self.change_marker)
+
+
+    @classmethod
+    def sync(self):
+        """
+        applies the rows, which have been changed since the stored marker,
+        in transactions of `follow_batch_size` rows. Existing instances are
+        updated with `hook_update_existing` (or upserted if `upsert_fields` is
+        set). The marker is stored in the same transaction.
+
+        returns a dict with the number of applied `rows`, the new `marker` and
+        the `lag`, the highest number of seconds between the change of a row
+        and applying it. The lag is None if `change_marker` is no timestamp.
+        """
+        if self.search_attr is None:
+            raise ImproperlyConfigured(
+                '%s: `search_attr` is required for following changes' % self)
+
+        stored = SyncMarker.objects.filter(classname=str(self))[:1]
+        marker = stored[0].value if stored else None
+        keys = set(json.loads(stored[0].keys)) if stored else set()
+        applied = 0
+        lag = None
+
+        connection = self.open_db_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(self.follow_query(marker))
+
+            while True:
+                rows = cursor.fetchmany(self.follow_batch_size)
+                if not rows:
+                    break
+
+                # skip the rows with the stored marker, which have been
+                # applied before
+                rows = [ row for row in rows if not (
+                    self.quote_marker(row[self.change_marker]) == marker and
+                    str(row[self.search_attr]) in keys) ]
+                if not rows:
+                    continue
+
+                # the hooks may change the rows
+                changes = [ row[self.change_marker] for row in rows ]
+                last = self.quote_marker(changes[-1])
+                if last != marker:
+                    keys = set()
+                keys.update(str(row[self.search_attr]) for row in rows
+                    if self.quote_marker(row[self.change_marker]) == last)
+
+                started = time.time()
+                updating = not self.upsert_fields
+                deferred = self.deferred_columns()
+
+                with atomic():
+                    # only the instances of this batch are looked up instead
+                    # of prefetching the whole table on every poll
+                    if updating:
+                        self.cache_relation(self.model, self.search_attr,
+                            [ row[self.search_attr] for row in rows ])
+
+                    self.process_rows(rows, updating=updating)
+
+                    if deferred:
+                        for name, desc in deferred.items():
+                            if desc['prefetch']:
+                                self.cache_relation(desc['klass'], desc['attr'],
+                                    [ value for pk, value in
+                                        Migration.deferred_relations.get((self, name), []) ],
+                                    desc['assign_by_id'])
+                        self.resolve_deferred_relations()
+                    self.store_change_marker(changes[-1], keys)
+
+                # the next batch may reference the instances of this one
+                self.relation_cache.pop(self.model, None)
+                for desc in deferred.values():
+                    self.relation_cache.pop(desc['klass'], None)
+
+                self.record_batch(rows, time.time() - started)
+
+                marker = last
+                applied += len(rows)
+
+                for changed in changes:
+                    if not isinstance(changed, datetime):
+                        changed = parse_datetime(str(changed))
+                    if changed is None:
+                        continue
+
+                    now = timezone.now() if timezone.is_aware(changed) \
+                        else datetime.now()
+                    delay = (now - changed).total_seconds()
+                    lag = delay if lag is None else max(lag, delay)
+
+                if lag is not None and Migration.metrics is not None:
+                    Migration.metrics.gauge('lag_seconds', self, lag)
+        finally:
+            connection.close()
+
+        return { 'rows': applied, 'marker': marker, 'lag': lag }
+
+
+    @classmethod
+    def verify(self, chunk_size=1000):
+        """
+        compares the rows returned by `query` with the instances of `model`.
+        Both sides are read in the order of `search_attr` and compared in
+        chunks of `chunk_size` rows by their checksums. The next chunk of the
+        legacy DB is read in a background thread meanwhile.
+
+        returns a dict with the keys `migration`, `source` and `target` (the
+        number of rows on both sides), `columns` and `differences`, a list of
+        (first key, last key, source rows, target rows) tuples for each
+        differing range of keys. A key of None means an open range.
+        """
+        key = self.search_attr
+        if key is None:
+            raise ImproperlyConfigured(
+                '%s: `search_attr` is required for verification' % self)
+
+        connection = self.open_db_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT * FROM (%s) q ORDER BY %s" % (
+                self.source_query().strip().rstrip(';'), key))
+
+            names = [ column[0] for column in cursor.description ]
+            columns = self.verify_columns or self.comparable_columns(names)
+            selected = [ key ] + [ column for column in columns if column != key ]
+
+            def chunks():
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+
+                    if not isinstance(rows[0], dict):
+                        rows = [ dict(zip(names, row)) for row in rows ]
+                    yield [ [ row[column] for column in selected ] for row in rows ]
+
+            result = { 'migration': self, 'source': 0, 'columns': selected,
+                       'differences': [] }
+            target = self.model.objects.order_by(key)
+            previous = None
+
+            for rows in iterate_in_background(chunks(), 2):
+                first, last = rows[0][0], rows[-1][0]
+
+                # the range starts after the previous chunk, so target rows
+                # between two chunks are found as well
+                instances = target.filter(**{ key + '__lte': last })
+                if previous is not None:
+                    instances = instances.filter(**{ key + '__gt': previous })
+
+                existing = list(instances.values_list(*selected))
+                if checksum(self.comparable_rows(selected, rows)) != \
+                        checksum(self.comparable_rows(selected, existing)):
+                    result['differences'].append(
+                        (first if previous is not None else None, last,
+                         len(rows), len(existing)))
+
+                result['source'] += len(rows)
+                previous = last
+        finally:
+            connection.close()
+
+        remaining = target
+        if previous is not None:
+            remaining = target.filter(**{ key + '__gt': previous })
+
+        extra = remaining.count()
+        if extra:
+            result['differences'].append((previous, None, 0, extra))
+
+        result['target'] = self.model.objects.count()
+        return result
+
+
+    @classmethod
+    def comparable_columns(self, names):
+        """
+        returns the supplied columns of `query`, which are compared with the
+        model fields of the same name by `verify`
+        """
+        fields = set( field.name for field in self.model._meta.local_fields )
+        return [ name for name in names
+                    if name in fields and name not in self.column_description ]
+
+
+    @classmethod
+    def comparable_rows(self, columns, rows):
+        """
+        converts the values of the supplied rows with the model fields of the
+        columns, so both sides of `verify` are compared as the same types.
+        Aware datetimes are converted to naive ones in the current timezone.
+        """
+        by_name = {}
+        for field in self.model._meta.local_fields:
+            by_name[field.name] = by_name[field.attname] = field
+
+        def convert(field, value):
+            if field is not None and value is not None:
+                try:
+                    value = field.to_python(value)
+                except ValidationError:
+                    return value
+
+            if isinstance(value, datetime) and timezone.is_aware(value):
+                value = timezone.make_naive(value, timezone.get_current_timezone())
+            return value
+
+        fields = [ by_name.get(column) for column in columns ]
+        return [ [ convert(field, value) for field, value in zip(fields, row) ]
+                    for row in rows ]
+
+
+    @classmethod
+    def open_source_connection(self):
+        """
+        returns the connection `query` is executed on. If `snapshot_dir` is
+        set, this is a connection to a local snapshot of the query result,
+        which is created first if it is missing or `query` has changed.
+        """
+        if self.snapshot_dir is None:
+            return self.open_db_connection()
+
+        snapshot = Snapshot(self.snapshot_dir,
+                            "%s.%s" % (self.__module__, self.__name__))
+
+        if not snapshot.is_current(self.source_query()):
+            print("Creating snapshot for %s" % self)
+
+            connection = self.open_db_connection()
+            try:
+                snapshot.create(connection, self.source_query(), self.batch_size)
+            finally:
+                connection.close()
+
+        return snapshot.connect()
+
+
+    @classmethod
+    def open_db_connection(self):
+        raise ImproperlyConfigured(
+            "You have to supply a suitable db connection for your DB: %s" % self)
+
+
+    @classmethod
+    def iterate_batches(self, cursor, transform=False):
+        """
+        generator over the batches of rows returned by `cursor` (at most
+        `row_limit` rows, while sampling). If `read_ahead` is set, the batches
+        are fetched by a background thread.
+
+        :param transform: call `hook_before_transformation` on each row while
+                          fetching (or in the process pool, if
+                          `transform_processes` is set). A row, where the
+                          hook fails, is replaced by a `TransformationFailure`.
+                          Each batch is a tuple of the transformed rows and
+                          their untransformed copies, see `transform_ahead`.
+        """
+        in_pool = transform and self.transform_processes > 0
+
+        def fetch():
+            remaining = self.row_limit
+            while remaining is None or remaining > 0:
+                size = self.current_batch_size or self.batch_size
+                if remaining is not None:
+                    size = min(size, remaining)
+                    remaining -= size
+
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+
+                if transform and not in_pool:
+                    rows = self.transform_ahead(rows)
+                yield rows
+
+        batches = fetch()
+        if in_pool:
+            batches = self.transform_in_pool(batches)
+
+        if self.read_ahead > 0:
+            return iterate_in_background(batches, self.read_ahead)
+
+        return batches
+
+
+    @classmethod
+    @contextmanager
+    def transform_workers(self):
+        """
+        starts the `transform_processes` worker processes, which are used by
+        `transform_in_pool` in this context. Forking a process while other
+        threads are running can deadlock it, so this has to be entered before
+        the threads of the migration are started and the pending row counts
+        are waited for.
+        """
+        if self.transform_processes <= 0:
+            yield
+            return
+
+        for call in Migration.row_counts.values():
+            call.wait()
+
+        pool = self.transform_pool = multiprocessing.Pool(
+            self.transform_processes, initializer=setup_transform_worker)
+        try:
+            yield
+        finally:
+            self.transform_pool = None
+            pool.terminate()
+            pool.join()
+
+
+    @classmethod
+    def transform_in_pool(self, batches):
+        """
+        generator over the supplied batches, which are transformed by the
+        processes of `transform_workers`. The order of the batches is kept and
+        at most two batches per process are transformed at once.
+        """
+        pool = self.transform_pool
+        pending = deque()
+
+        for rows in batches:
+            pending.append(pool.apply_async(transform_in_process, (self, rows)))
+
+            if len(pending) >= 2 * self.transform_processes:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+
+
+    @classmethod
+    def iterate_rows(self, cursor):
+        """generator over all rows returned by `cursor`"""
+        for rows in self.iterate_batches(cursor):
+            for row in rows:
+                yield row
+
+
+    @classmethod
+    def transform_in_advance(self, row):
+        try:
+            with self.query_phase('hooks'):
+                self.hook_before_transformation(row)
+            return row
+        except Exception as e:
+            return TransformationFailure(e, row)
+
+
+    @classmethod
+    def process_cursor(self, connection, cursor, fields):
+        total = self.hook_row_count(connection, cursor)
+        self.limit_sample(total)
+        current = 0
+        transformed = (self.read_ahead > 0 and self.transform_in_reader) or \
+            self.transform_processes > 0
+        batched = self.writes_in_bulk() or self.uses_batch_hooks()
+        adaptive = self.target_batch_latency or self.max_batch_memory
+
+        self.current_batch_size = self.batch_size if adaptive else None
+        if adaptive:
+            sizes = Migration.batch_sizes[str(self)] = []
+
+        self.hook_before_all()
+
+        for batch in self.iterate_batches(cursor, transform=transformed):
+            started = time.time()
+            rows, originals = batch if transformed else (batch, None)
+
+            if batched:
+                current += len(rows)
+                total = self.counted_rows(total)
+                sys.stdout.write("\rMigrating element %d/%d" % (current, total))
+                sys.stdout.flush()
+
+                self.create_instances_from_rows(rows, transformed=transformed,
+                                                originals=originals)
+
+            else:
+                for i, row in enumerate(rows):
+
+                    current += 1
+                    total = self.counted_rows(total)
+                    sys.stdout.write("\rMigrating element %d/%d" % (current, total))
+                    sys.stdout.flush()
+
+                    original = originals[i] if originals is not None else None
+
+                    if isinstance(row, TransformationFailure):
+                        self.hook_error_creating_instance(
+                            row.exception, original or row.row)
+                        continue
+
+                    self.create_instance_from_row(
+                        row, transformed=transformed, original=original)
+
+            self.record_batch(rows, time.time() - started)
+
+            if adaptive:
+                sizes.append(len(rows))
+                self.adapt_batch_size(rows, time.time() - started)
+
+        print("")
+
+        if adaptive:
+            self.current_batch_size = None
+            print("Batch sizes of %s: %d to %d rows" % (
+                self, min(sizes or [0]), max(sizes or [0])))
+
+        # upserting migrations are migrated multiple times
+        self.create_m2m_pairs(skip_existing=bool(self.upsert_fields))
+
+        self.hook_after_all()
+        return current
+
+
+    @classmethod
+    def adapt_batch_size(self, rows, elapsed):
+        """
+        sets the size of the next batch based on the time it has taken to
+        process `rows` and on their size
+        """
+        size = self.current_batch_size
+
+        # the last batch is usually incomplete and says nothing about the time
+        if self.target_batch_latency and elapsed > 0 and len(rows) == size:
+            wanted = self.target_batch_latency * len(rows) / elapsed
+            # change the size gradually, as single batches can be slow
+            size = max(size // 2, min(size * 2, int(wanted)))
+
+        if self.max_batch_memory and rows:
+            sample = [ row for row in rows[:10] if isinstance(row, dict) ]
+            row_size = sum(approximate_size(row) for row in sample) / \
+                float(len(sample) or 1)
+            if row_size > 0:
+                size = min(size, int(self.max_batch_memory / row_size))
+
+        self.current_batch_size = max(self.min_batch_size,
+                                      min(self.max_batch_size, size))
+
+
+    @classmethod
+    def process_cursor_for_update(self, connection, cursor, fields):
+        total = self.hook_row_count(connection, cursor)
+        self.limit_sample(total)
+        created = 0
+        existing = 0
+
+        for row in self.iterate_rows(cursor):
+            started = time.time()
+
+            if self.update_from_row(row):
+                existing += 1
+            else:
+                created += 1
+
+            self.record_batch([ row ], time.time() - started)
+
+            total = self.counted_rows(total)
+            sys.stdout.write(
+                "\rSearch for missing Instances (exist/created/total):  %d/%d/%d" % (
+                    existing, created, total))
+            sys.stdout.flush()
+
+        print("")
+        self.create_m2m_pairs(skip_existing=True)
+        return existing + created
+
+
+    @classmethod
+    def update_from_row(self, row):
+        """
+        calls `hook_update_existing` for the existing instance, which matches
+        the supplied row by `search_attr`, or creates a new instance.
+
+        returns True if the instance has existed
+        """
+        desc = is_a(self.model, search_attr=self.search_attr,
+                    fk=True, skip_missing=True)
+        with self.query_phase('lookup'):
+            element = self.get_object(desc, row[self.search_attr])
+
+        if element is None:
+            self.create_instance_from_row(row)
+            return False
+
+        with self.query_phase('hooks'):
+            self.hook_update_existing(element, row)
+        return True
+
+
+    @classmethod
+    def process_rows(self, rows, updating=False):
+        """
+        migrates a batch of rows, which has been read by the `shared_source`
+        or by `sync`
+
+        :param updating: update existing instances like
+                         `process_cursor_for_update`
+        """
+        if updating:
+            for row in rows:
+                self.update_from_row(row)
+
+        elif self.writes_in_bulk() or self.uses_batch_hooks():
+            self.create_instances_from_rows(rows)
+
+        else:
+            for row in rows:
+                self.create_instance_from_row(row)
+
+
+    @classmethod
+    def create_instance_from_row(self, row, transformed=False, original=None):
+        """
+        utility method that creates the suitable instance from row and calls
+        the required hook methods.
+
+        :param transformed: `hook_before_transformation` has already been
+                            called for this row
+        :param original: the untransformed copy of a transformed row, which
+                         is put into quarantine if the row fails
+        """
+        if self.uses_batch_hooks():
+            # the batch hooks are called for a batch of this row only
+            self.create_instances_from_rows(
+                [ row ], transformed=transformed,
+                originals=[ original ] if original is not None else None)
+            return
+
+        def create(row):
+            instance, m2ms = self.build_instance(row, transformed=transformed)
+            if instance is None:
+                sys.stdout.write("Skipping: before_save returned False")
+                self.record_metric('rows_skipped')
+                return
+
+            self.save_instance(instance, m2ms, row)
+
+        if self.max_failures is None:
+            try:
+                create(row)
+            except Exception as e:
+                self.hook_error_creating_instance(e, row)
+            return
+
+        # keep the untransformed row for the quarantine and wrap the row in
+        # a savepoint, so a failing row doesn't break the transaction
+        if original is None:
+            original = dict(row)
+        try:
+            with self.query_phase('save'), savepoint():
+                create(row)
+        except Exception as e:
+            self.hook_error_creating_instance(e, original)
+
+
+    @classmethod
+    def create_instances_from_rows(self, rows, transformed=False,
+                                   originals=None):
+        """
+        creates the instances for the supplied batch of rows, with
+        `bulk_create` if `bulk_insert` is set. Rows failing before the
+        instance is written are passed to `hook_error_creating_instance`
+        directly.
+        """
+        entries = self.build_batch(rows, transformed=transformed,
+                                   originals=originals)
+
+        if self.writes_in_bulk():
+            self.bulk_write([ (entry[0], entry[3]) for entry in entries ])
+            return
+
+        after_save_batch = self.overrides('hook_after_save_batch')
+        saved = []
+
+        for instance, m2ms, row, original in entries:
+            try:
+                if self.max_failures is None:
+                    self.save_instance(instance, m2ms, row,
+                                       after_save=not after_save_batch)
+                else:
+                    with self.query_phase('save'), savepoint():
+                        self.save_instance(instance, m2ms, row,
+                                           after_save=not after_save_batch)
+            except Exception as e:
+                self.hook_error_creating_instance(e, original)
+                continue
+
+            saved.append((instance, row))
+
+        if after_save_batch and saved:
+            with self.query_phase('hooks'):
+                self.hook_after_save_batch([ inst for inst, row in saved ],
+                                           [ row for inst, row in saved ])
+
+
+    @classmethod
+    def save_instance(self, instance, m2ms, row, after_save=True):
+        """saves the instance and its m2m relations and calls `hook_after_save`"""
+        with self.query_phase('save'):
+            instance.save()
+
+        self.record_metric('rows_written')
+        self.defer_relations([ (instance, row) ])
+
+        with self.query_phase('m2m'):
+            self.create_m2ms(instance, m2ms)
+
+        if after_save:
+            with self.query_phase('hooks'):
+                self.hook_after_save(instance, row)
+
+
+    @classmethod
+    def bulk_write(self, pairs):
+        """
+        writes the instances of the supplied (instance, row) pairs in a
+        savepoint with `bulk_create` (or `upsert_instances` if `upsert_fields`
+        is set). If the database rejects it, the batch is split recursively
+        until the failing rows are isolated, which are passed to
+        `hook_error_creating_instance`. Other errors are raised.
+        """
+        if not pairs:
+            return
+
+        try:
+            with self.query_phase('save'), savepoint():
+                instances = [ inst for inst, row in pairs ]
+                if self.upsert_fields:
+                    self.upsert_instances(instances)
+                else:
+                    self.model.objects.bulk_create(instances)
+
+                self.defer_relations(pairs)
+
+            self.record_metric('rows_written', len(pairs))
+
+        except DatabaseError as e:
+            if len(pairs) == 1:
+                self.hook_error_creating_instance(e, pairs[0][1])
+                return
+
+            middle = len(pairs) // 2
+            self.bulk_write(pairs[:middle])
+            self.bulk_write(pairs[middle:])
+
+
+    @classmethod
+    def deferred_columns(self):
+        """returns the column descriptions of the deferred relations"""
+        return dict( (name, desc) for name, desc in self.column_description.items()
+                        if desc['deferred'] and not desc['exclude'] )
+
+
+    @classmethod
+    def dependencies(self):
+        """
+        returns the models of `depends_on`, which are not only referenced by
+        deferred relations
+        """
+        deferred = set( desc['klass'] for desc in self.deferred_columns().values() )
+        required = set( desc['klass'] for desc in self.column_description.values()
+                            if not desc['deferred'] and not desc['exclude'] )
+
+        return [ model for model in self.depends_on
+                    if model not in deferred or model in required ]
+
+
+    @classmethod
+    def defer_relations(self, pairs):
+        """
+        remembers the values of the deferred columns for the supplied saved
+        (instance, row) pairs
+        """
+        for name in self.deferred_columns():
+            pending = Migration.deferred_relations.setdefault((self, name), [])
+
+            for instance, row in pairs:
+                if row.get(name) is None:
+                    continue
+
+                if instance.pk is None:
+                    raise ImproperlyConfigured(
+                        '%s: deferred relations require the primary key of '
+                        'the instances to be known after saving' % self)
+
+                pending.append((instance.pk, row[name]))
+
+
+    @classmethod
+    def resolve_deferred_relations(self):
+        """
+        sets the deferred relations of the instances created by this
+        migration with bulk UPDATEs in batches of `batch_size`
+        """
+        qn = django_connection.ops.quote_name
+        meta = self.model._meta
+        cursor = django_connection.cursor()
+
+        for name, desc in self.deferred_columns().items():
+            pending = Migration.deferred_relations.pop((self, name), [])
+            column = qn(meta.get_field(name).column)
+            resolved = 0
+
+            for start in range(0, len(pending), self.batch_size):
+                cases = []
+                params = []
+
+                for pk, value in pending[start:start + self.batch_size]:
+                    with self.query_phase('lookup'):
+                        related = self.get_object(desc, value)
+                    if related is None:
+                        continue
+
+                    cases.append((pk, getattr(related, 'pk', related)))
+
+                # stay below the limit of query parameters (e.g. of sqlite)
+                size = max(1, django_connection.ops.bulk_batch_size(
+                    [ 'pk', 'value', 'pk' ], cases))
+
+                for offset in range(0, len(cases), size):
+                    chunk = cases[offset:offset + size]
+                    params = [ param for case in chunk for param in case ] + \
+                        [ pk for pk, related in chunk ]
+
+                    cursor.execute(
+                        "UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)" % (
+                            qn(meta.db_table), column, qn(meta.pk.column),
+                            " ".join([ "WHEN %s THEN %s" ] * len(chunk)),
+                            qn(meta.pk.column), ", ".join([ "%s" ] * len(chunk))),
+                        params)
+                    resolved += len(chunk)
+
+            print("Resolved %d deferred relations of %s.%s" % (
+                resolved, self, name))
+
+
+    @classmethod
+    def writes_in_bulk(self):
+        """checks if the instances are written with `bulk_write`"""
+        if self.bulk_insert or self.upsert_fields:
+            return True
+
+        # a full refresh is written in bulk, if it is possible
+        return bool(self.full_refresh) and self.bulk_write_conflict() is None
+
+
+    @classmethod
+    def bulk_write_conflict(self):
+        """
+        returns the reason why the instances can not be written with
+        `bulk_write` or None
+        """
+        if any(desc['m2m'] and not desc['pairs_query']
+                for desc in self.column_description.values()):
+            return 'm2m columns, which do not define a `pairs_query`'
+
+        for hook in ('hook_after_save', 'hook_after_save_batch'):
+            if self.overrides(hook):
+                return 'a `%s`' % hook
+
+        if self.deferred_columns() and not self.bulk_write_sets_pks():
+            return 'deferred relations, because the primary keys are not ' \
+                'known after writing. Return them from the query'
+
+        return None
+
+
+    @classmethod
+    def bulk_write_sets_pks(self):
+        """
+        checks if the instances have their primary keys after `bulk_write`,
+        either because the rows contain them or because the database returns
+        them from bulk inserts
+        """
+        pk = self.model._meta.pk
+        if not isinstance(pk, AutoField) or self.search_attr in (pk.name, pk.attname):
+            return True
+
+        if self.upsert_fields:
+            return False
+
+        features = django_connection.features
+        return DJANGO_VERSION >= (1, 10) and (
+            getattr(features, 'can_return_rows_from_bulk_insert', False) or
+            getattr(features, 'can_return_ids_from_bulk_insert', False))
+
+
+    @classmethod
+    def clear_target(self):
+        """
+        deletes all instances of `model` and their m2m relations for
+        `full_refresh`. DELETE is used instead of TRUNCATE, which fails on
+        PostgreSQL for referenced tables, while the foreign key constraints
+        are checked at the end of the transaction.
+        """
+        qn = django_connection.ops.quote_name
+        meta = self.model._meta
+
+        tables = [ (getattr(field, 'remote_field', None) or field.rel
+                        ).through._meta.db_table
+                    for field in meta.local_many_to_many ] + [ meta.db_table ]
+
+        cursor = django_connection.cursor()
+        with self.query_phase('save'):
+            for table in tables:
+                cursor.execute("DELETE FROM %s" % qn(table))
+
+        # the cached instances do not exist anymore
+        self.relation_cache.pop(self.model, None)
+        print("Deleted all instances of %s" % self.model.__name__)
+
+
+    @classmethod
+    def referencing_relations(self):
+        """returns the relations of other models (or itself) to `model`"""
+        meta = self.model._meta
+        if hasattr(meta, 'related_objects'):
+            return list(meta.related_objects)
+
+        return meta.get_all_related_objects() + \
+            meta.get_all_related_many_to_many_objects()
+
+
+    @classmethod
+    def upsert_instances(self, instances):
+        """
+        inserts the supplied instances or overwrites the `upsert_fields` of
+        the existing instances with the same `search_attr`
+        """
+        if DJANGO_VERSION >= (4, 1):
+            # MySQL always updates on the conflicting unique key and does not
+            # support naming it
+            conflict = {}
+            if django_connection.features.supports_update_conflicts_with_target:
+                conflict['unique_fields'] = [ self.search_attr ]
+
+            self.model.objects.bulk_create(
+                instances, update_conflicts=True,
+                update_fields=self.upsert_fields, **conflict)
+            return
+
+        qn = django_connection.ops.quote_name
+        meta = self.model._meta
+
+        # let the DB generate missing primary keys (local_concrete_fields
+        # needs Django >= 1.6)
+        fields = [ field for field in meta.local_fields if field.column and (
+                    field is not meta.pk or
+                        all(inst.pk is not None for inst in instances)) ]
+        updated = [ qn(meta.get_field(name).column)
+                        for name in self.upsert_fields ]
+
+        if django_connection.vendor == 'mysql':
+            conflict = "ON DUPLICATE KEY UPDATE %s" % ", ".join(
+                "%s = VALUES(%s)" % (column, column) for column in updated)
+        else:
+            conflict = "ON CONFLICT (%s) DO UPDATE SET %s" % (
+                qn(meta.get_field(self.search_attr).column), ", ".join(
+                    "%s = EXCLUDED.%s" % (column, column) for column in updated))
+
+        placeholder = "(%s)" % ", ".join([ "%s" ] * len(fields))
+        size = max(1, django_connection.ops.bulk_batch_size(fields, instances))
+        cursor = django_connection.cursor()
+
+        for start in range(0, len(instances), size):
+            batch = instances[start:start + size]
+            params = [ field.get_db_prep_save(field.pre_save(inst, True),
+                                              connection=django_connection)
+                        for inst in batch for field in fields ]
+
+            cursor.execute("INSERT INTO %s (%s) VALUES %s %s" % (
+                qn(meta.db_table),
+                ", ".join(qn(field.column) for field in fields),
+                ", ".join([ placeholder ] * len(batch)), conflict), params)
+
+
+    @classmethod
+    def record_metric(self, name, value=1):
+        """increments a counter of the exported `metrics` of the current run"""
+        if Migration.metrics is not None:
+            Migration.metrics.increment(name, self, value)
+
+
+    @classmethod
+    def record_batch(self, rows, elapsed):
+        """
+        records the rows read for a processed batch and the time it has taken
+        in `processed_rows` and the exported `metrics` of the current run
+        """
+        self.processed_rows += len(rows)
+
+        metrics = Migration.metrics
+        if metrics is None:
+            return
+
+        metrics.increment('rows_read', self, len(rows))
+        metrics.gauge('batch_latency_seconds', self, elapsed)
+        metrics.relation_cache_entries = sum(
+            len(cache) for cache in self.relation_cache.values())
+        metrics.flush()
+
+
+    @classmethod
+    def quarantine_row(self, exception, row):
+        """
+        stores the failing row in the quarantine and aborts the run if there
+        are more than `max_failures` failing rows
+        """
+        entry = QuarantinedRow.objects.create(
+            classname=str(self),
+            row=json.dumps(row, cls=RowEncoder),
+            exception="%s: %s" % (exception.__class__.__name__, exception))
+
+        # stored again, if the run is rolled back by `FailureThresholdExceeded`
+        Migration.quarantined.append(entry)
+
+        self.record_metric('rows_failed')
+
+        self.failures += 1
+        if self.failures > self.max_failures:
+            raise FailureThresholdExceeded(
+                "%s: more than %d rows have failed" % (self, self.max_failures))
+
+
+    @classmethod
+    def transform_row_dataset(self, datarow):
+        """transforms the supplied row and evaluates columns of different types
+
+        returns the dict where columns which FKs or Data has been updated with
+        real instances
+        """
+        constructor_data = {}
+        m2ms = {}
+
+        for fieldname, data in datarow.items():
+            if fieldname in self.column_description:
+                desc = self.column_description[fieldname]
+
+                if desc['exclude']:
+                    continue
+
+                elif desc['deferred']:
+                    # saved as NULL and resolved after the run
+                    continue
+
+                elif desc['fk'] or desc['o2o']:
+                    instance = self.get_object(desc, data)
+                    if desc['assign_by_id']:
+                        fieldname += "_id"
+
+                    constructor_data[fieldname] = instance
+
+                elif desc['m2m']:
+                    if data is None or desc['pairs_query']:
+                        continue
+
+                    parts = data.split(desc['delimiter'])
+                    objects = []
+
+                    for part in parts:
+                        element = self.get_object(desc, part)
+                        if element is None:
+                            continue
+                        objects.append(element)
+                    m2ms[fieldname] = objects
+
+            else:
+                constructor_data[fieldname] = data
+
+        return (constructor_data, m2ms,)
+
+
+    @classmethod
+    def get_object(self, desc, value):
+        klass = desc['klass']
+        attr  = desc['attr']
+
+        try:
+            if desc['prefetch']:
+
+                # build up relation cache
+                if klass not in self.relation_cache:
+                    self.buildup_relation_cache(klass, attr, value,
+                                                desc['assign_by_id'])
+
+                # get the instance out of relation cache
+                inst = self.relation_cache[klass].get(value, None)
+                if inst:
+                    return inst
+
+                # add an instance written after prefetching, which hasn't
+                # been found by `extend_incomplete_caches`, to the cache
+                if klass in self.incomplete_caches:
+                    found = klass.objects.filter(**{ attr: value })
+                    if desc['assign_by_id']:
+                        found = found.values_list('pk', flat=True)
+
+                    for inst in found[:1]:
+                        self.relation_cache[klass][value] = inst
+                        return inst
+
+                raise ObjectDoesNotExist(
+                    "%s matching query (%s=%s) does not exist in relation cache." % (
+                        klass.__name__, attr, value))
+
+            else:
+                # get the related object out of the DB
+                return klass.objects.get(**{ attr: value })
+
+        except ObjectDoesNotExist as e:
+            # the object could have been validated but not saved before
+            validated = Migration.validated_index.get((klass, attr), {})
+            if str(value) in validated:
+                pk = validated[str(value)]
+                return pk if desc['assign_by_id'] else klass(pk=pk)
+
+            if desc['skip_missing']:
+                return None
+            else:
+                raise
+
+
+    @classmethod
+    def buildup_relation_cache(self, klass, attr, value, assign_by_id):
+        """this builds up the relation cache for the supplied supplied class
+        """
+
+        # we have to use the right type as the relation_cache key
+        # because the attr could be in the wrong type when it comes from
+        # the sql query
+        type_of_attr = type(value)
+
+        if assign_by_id:
+            # get a mapping from attr to pk which is more memory
+            # efficient as full object construction
+            cache = dict(
+                ( type_of_attr(left), right )
+                    for left, right in
+                        klass.objects.all().values_list(attr, 'pk')
+            )
+
+        else:
+            # get a mapping with full objects
+            cache = dict(
+                ( type_of_attr(inst.__getattribute__(attr)), inst )
+                    for inst in klass.objects.all()
+            )
+
+        self.relation_cache[klass] = cache
+
+        if self.track_memory:
+            self.cache_usage[klass.__name__] = {
+                'entries': len(cache), 'bytes': approximate_size(cache) }
+
+
+    @classmethod
+    def cache_relation(self, klass, attr, values, assign_by_id=False):
+        """
+        builds up the relation cache of `klass` only for the instances, where
+        `attr` is one of the supplied values, instead of all instances like
+        `buildup_relation_cache`
+        """
+        self.relation_cache[klass] = {}
+        self.extend_relation_cache(klass, attr, values, assign_by_id)
+
+
+    @classmethod
+    def extend_relation_cache(self, klass, attr, values, assign_by_id=False):
+        """
+        adds the instances, where `attr` is one of the supplied values, to the
+        relation cache of `klass`, if they are missing there
+        """
+        cache = self.relation_cache.setdefault(klass, {})
+        values = list(set( value for value in values
+                              if value is not None and value not in cache ))
+
+        # stay below the limit of query parameters (e.g. of sqlite)
+        size = max(1, django_connection.ops.bulk_batch_size([ attr ], values))
+
+        for start in range(0, len(values), size):
+            chunk = values[start:start + size]
+            type_of_attr = type(chunk[0])
+            lookup = { '%s__in' % attr: chunk }
+
+            with self.query_phase('lookup'):
+                if assign_by_id:
+                    cache.update(
+                        ( type_of_attr(left), right ) for left, right in
+                            klass.objects.filter(**lookup).values_list(attr, 'pk'))
+                else:
+                    cache.update(
+                        ( type_of_attr(getattr(inst, attr)), inst ) for inst in
+                            klass.objects.filter(**lookup))
+
+
+    @classmethod
+    def extend_incomplete_caches(self, rows):
+        """
+        adds the instances referenced by the supplied rows to the relation
+        caches of `incomplete_caches`, which have been built up already
+        """
+        for name, desc in self.column_description.items():
+            klass = desc['klass']
+            if desc['exclude'] or not (desc['fk'] or desc['o2o']) or \
+                    not desc['prefetch'] or klass not in self.incomplete_caches or \
+                    klass not in self.relation_cache:
+                continue
+
+            self.extend_relation_cache(klass, desc['attr'],
+                [ row.get(name) for row in rows ], desc['assign_by_id'])
+
+
+    @classmethod
+    def cleanup_relation_cache(self):
+        """
+        This deletes the relation cache as it is a class-level variable which
+        is not garbage collected otherwise. Not cleaning up this cache after
+        usage can lead to serious memory usage.
+        """
+        self.relation_cache = {}
+
+
+    @classmethod
+    def create_m2ms(self, instance, m2ms):
+        for field, values in m2ms.items():
+            instance.__getattribute__(field).add(*values)
+
+
+    @classmethod
+    def pair_columns(self):
+        """returns the m2m column descriptions, which define a `pairs_query`"""
+        return dict( (name, desc) for name, desc in self.column_description.items()
+                        if desc['m2m'] and desc['pairs_query'] )
+
+
+    @classmethod
+    def create_m2m_pairs(self, skip_existing=False):
+        """
+        executes the `pairs_query` of each m2m column and writes the pairs to
+        the through-table of the m2m field in batches of `batch_size`
+
+        :param skip_existing: pairs, which already exist, are not written
+                              again
+        """
+        for name, desc in self.pair_columns().items():
+            field = self.model._meta.get_field(name)
+            through = (getattr(field, 'remote_field', None) or field.rel).through
+            owner_field = "%s_id" % field.m2m_field_name()
+            related_field = "%s_id" % field.m2m_reverse_field_name()
+
+            owner_attr = desc['owner_attr'] or self.search_attr or 'pk'
+            owners = None
+            existing = set()
+            if skip_existing:
+                existing = set(through.objects.values_list(
+                    owner_field, related_field))
+
+            connection = self.open_db_connection()
+            try:
+                cursor = connection.cursor()
+                cursor.execute(desc['pairs_query'])
+                written = 0
+
+                while True:
+                    rows = cursor.fetchmany(self.batch_size)
+                    if not rows:
+                        break
+
+                    pairs = []
+                    for row in rows:
+                        if isinstance(row, dict):
+                            row = [ row[column[0]] for column in cursor.description ]
+                        owner, value = row[0], row[1]
+
+                        # the owners are read after all instances have been
+                        # created, so they are complete
+                        if owners is None:
+                            type_of_owner = type(owner)
+                            owners = dict(
+                                ( type_of_owner(left), right ) for left, right in
+                                    self.model.objects.values_list(owner_attr, 'pk'))
+
+                        owner_pk = owners.get(owner)
+
+                        # the owner is possibly not part of the sample
+                        if owner_pk is None and self.row_limit is not None:
+                            continue
+
+                        related = self.get_object(desc, value)
+
+                        if owner_pk is None and not desc['skip_missing']:
+                            raise ObjectDoesNotExist(
+                                "%s matching query (%s=%s) does not exist." % (
+                                    self.model.__name__, owner_attr, owner))
+
+                        if owner_pk is None or related is None:
+                            continue
+
+                        pair = (owner_pk, getattr(related, 'pk', related))
+                        if pair in existing:
+                            continue
+
+                        existing.add(pair)
+                        pairs.append(through(**{ owner_field: pair[0],
+                                                 related_field: pair[1] }))
+
+                    with self.query_phase('m2m'):
+                        through.objects.bulk_create(pairs)
+                    written += len(pairs)
+            finally:
+                connection.close()
+
+            print("Created %d relations for %s" % (written, name))
+
+
+    @classmethod
+    def migration_required(self):
+        """checks if the migration has already been applied"""
+        try:
+            AppliedMigration.objects.get(classname=str(self))
+
+            if self.full_refresh:
+                return True
+
+            if self.allow_updates:
+                return None
+
+            return False
+        except AppliedMigration.DoesNotExist as e:
+            return True
+
+
+    @classmethod
+    def overrides(self, hook):
+        """checks if the supplied hook is overridden by this migration"""
+        method = getattr(self, hook)
+        return getattr(method, '__func__', None) is not \
+            getattr(Migration, hook).__func__
+
+
+    @classmethod
+    def check_migration(self):
+
+        if not isinstance(self.column_description, dict):
+            raise ImproperlyConfigured(
+                    '%s: `column_description` has to be a dict' % self)
+
+        if self.allow_updates and self.search_attr is None:
+            raise ImproperlyConfigured(
+                    '%s: `allow_updates` forces you to set the `search_attr` on ' % self +
+                    'the Migration. to search for existing instances. Example: `username`')
+
+        if not isinstance(self.depends_on, list):
+            raise ImproperlyConfigured(
+                    '%s: `depends_on` has to be a list of classes' % self)
+
+        if not ( inspect.isclass(self.model) and issubclass(self.model, Model)):
+            raise ImproperlyConfigured(
+                    '%s: `model` has to be a model CLASS' % self)
+
+        if self.pushdown:
+            self.check_pushdown()
+
+        if self.upsert_fields and not self.allow_updates:
+            raise ImproperlyConfigured(
+                '%s: `upsert_fields` requires `allow_updates`' % self)
+
+        if self.upsert_fields and django_connection.vendor not in (
+                'postgresql', 'sqlite', 'mysql'):
+            raise ImproperlyConfigured(
+                '%s: `upsert_fields` is not supported by %s' % (
+                    self, django_connection.vendor))
+
+        for option in ('bulk_insert', 'upsert_fields'):
+            conflict = self.bulk_write_conflict()
+            if getattr(self, option) and conflict is not None:
+                raise ImproperlyConfigured(
+                    '%s: `%s` is not possible with %s' % (self, option, conflict))
+
+        for name in self.deferred_columns():
+            if not self.model._meta.get_field(name).null:
+                raise ImproperlyConfigured(
+                    '%s: the deferred relation `%s` has to be nullable' % (
+                        self, name))
+
+        if self.full_refresh and self.upsert_fields:
+            raise ImproperlyConfigured(
+                '%s: `full_refresh` is not possible with `upsert_fields`' % self)
+
+        # InnoDB checks the foreign keys immediately
+        if self.full_refresh and django_connection.vendor == 'mysql' and \
+                self.referencing_relations():
+            raise ImproperlyConfigured(
+                '%s: `full_refresh` is not possible on MySQL for models, '
+                'which are referenced by other models' % self)
+
+        if self.shared_source is not None and (self.pushdown or
+                self.transform_processes or self.target_batch_latency or
+                self.max_batch_memory):
+            raise ImproperlyConfigured(
+                '%s: `shared_source` is not possible with `pushdown`, '
+                '`transform_processes` or adaptive batch sizes' % self)
+
+        if not re.search('SELECT', self.source_query(), re.IGNORECASE|re.MULTILINE):
+            raise ImproperlyConfigured(
+                '%s: `query` has to be a string containing SELECT: %s' % (
+                    self, self.source_query()))
+
+
+class SharedSource(object):
+    """
+    Baseclass for a query of the legacy DB, which is migrated by several
+    migrations, e.g. if several models are built out of the same wide table.
+    These migrations set `shared_source` instead of `query`. The query is
+    executed once and each batch of rows is passed to all of them in their
+    dependency order, each with its own `column_description` and hooks.
+    """
+
+    #: An SQL-SELECT-query, which returns the columns of all migrations
+    query = None
+
+    #: The number of rows which are fetched from the legacy DB at once.
+    batch_size = 1000
+
+    #: The number of batches which are read ahead from the legacy DB by a
+    #: background thread, see `Migration.read_ahead`.
+    read_ahead = 0
+
+    @classmethod
+    def open_db_connection(self):
+        raise ImproperlyConfigured(
+            "You have to supply a suitable db connection for your DB: %s" % self)
+
+
+    @classmethod
+    def migrate(self, migrations):
+        """
+        migrates the supplied migrations, which have to be in dependency
+        order, with a single scan of `query`. Each migration gets its own
+        copy of each row, as the hooks may change the rows.
+
+        returns the number of rows read from the legacy DB
+        """
+        active = self.active_migrations(migrations)
+        if not active:
+            return 0
+
+        print("Migrating %s from %s" % (
+            ", ".join(str(entry[0]) for entry in active), self))
+
+        # rows changed while migrating are applied again when following
+        markers = dict( (entry[0], entry[0].current_change_marker())
+                            for entry in active if entry[0].change_marker )
+
+        current, durations = self.write_rows(active)
+
+        for migration, check, updating in active:
+            if migration.mute_signals:
+                migration.hook_after_muted_signals()
+
+            if check is not None:
+                AppliedMigration.objects.get_or_create(classname=str(migration))
+
+            if markers.get(migration) is not None:
+                migration.store_change_marker(markers[migration])
+
+            MigrationRun.objects.create(classname=str(migration), rows=current,
+                                        duration=durations[migration])
+
+        return current
+
+
+    @classmethod
+    def sample(self, migrations, limit=None, percentage=None):
+        """
+        migrates only the first `limit` rows or `percentage` percent of all
+        rows with a single scan, see `Migration.sample`. A failing row ends
+        the sample of all the migrations.
+
+        returns a list with the result of each migration
+        """
+        active = self.active_migrations(migrations)
+        if not active:
+            return []
+
+        print("Sampling %s from %s" % (
+            ", ".join(str(entry[0]) for entry in active), self))
+
+        counter = BackgroundCall(self.count_rows)
+
+        if percentage is not None:
+            limit = int(math.ceil(counter.result() * percentage / 100.0))
+
+        migrations = [ entry[0] for entry in active ]
+        for migration in migrations:
+            migration.failures = 0
+            migration.processed_rows = 0
+
+        durations = {}
+        try:
+            with savepoint():
+                self.write_rows(active, limit=limit, durations=durations)
+
+                for migration in migrations:
+                    started = time.time()
+                    if migration.mute_signals:
+                        migration.hook_after_muted_signals()
+                    durations[migration] += time.time() - started
+        except ImproperlyConfigured:
+            raise
+        except Exception as e:
+            sys.stderr.write("\nError: Sampling %s has failed: %s: %s\n" % (
+                self, e.__class__.__name__, e))
+
+            # each batch is passed to the migrations in order, so the failing
+            # one is the first, which has processed less rows than the others
+            failing = migrations[0]
+            for migration in migrations:
+                if migration.processed_rows < migrations[0].processed_rows:
+                    failing = migration
+                    break
+            failing.failures += 1
+
+        total = counter.result()
+        return [ sample_result(migration, total, migration.processed_rows,
+                               migration.failures, durations[migration])
+                    for migration in migrations ]
+
+
+    @classmethod
+    def count_rows(self):
+        """counts the rows of `query` on a separate connection"""
+        connection = self.open_db_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT COUNT(*) AS row_count FROM (%s) counted" % (
+                self.query.strip().rstrip(';')))
+            row = cursor.fetchone()
+        finally:
+            connection.close()
+
+        if isinstance(row, dict):
+            return int(row['row_count'])
+        return int(row[0])
+
+
+    @classmethod
+    def active_migrations(self, migrations):
+        """
+        returns a (migration, check, updating) tuple for each of the supplied
+        migrations, which is required
+        """
+        active = []
+        for migration in migrations:
+            check = migration.migration_required()
+            if check == False:
+                print("%s has already been migrated, skip it!" % migration)
+                continue
+
+            migration.check_migration()
+            # see `Migration.migrate`
+            updating = check is None and not migration.upsert_fields
+            active.append((migration, check, updating))
+
+        return active
+
+
+    @classmethod
+    def write_rows(self, active, limit=None, durations=None):
+        """
+        writes the first `limit` rows (or all rows) of `query` for the
+        supplied (migration, check, updating) tuples in a single scan. This is
+        shared by `migrate` and `sample`.
+
+        :param durations: the dict, which is filled with the time each
+                          migration has taken
+
+        returns a tuple of the number of rows read and `durations`
+        """
+        if durations is None:
+            durations = {}
+        durations.update( (entry[0], 0.0) for entry in active )
+        signals = []
+        for migration, check, updating in active:
+            signals.extend(signal for signal in migration.muted_signals()
+                                if signal not in signals)
+
+        with muted_signals(signals):
+            for migration, check, updating in active:
+                started = time.time()
+                migration.failures = 0
+
+                if migration.full_refresh:
+                    migration.clear_target()
+                if not updating:
+                    migration.hook_before_all()
+                durations[migration] += time.time() - started
+
+            # the prefetched instances of the models written by the previous
+            # migrations miss the rows of the current batch
+            for index, (migration, check, updating) in enumerate(active):
+                migration.incomplete_caches = [ entry[0].model
+                                                    for entry in active[:index] ]
+
+            current = 0
+            connection = self.open_db_connection()
+            try:
+                cursor = connection.cursor()
+                cursor.execute(self.query)
+
+                for rows in self.iterate_batches(cursor, limit=limit):
+                    current += len(rows)
+                    sys.stdout.write("\rMigrating element %d" % current)
+                    sys.stdout.flush()
+
+                    for migration, check, updating in active:
+                        started = time.time()
+                        migration.extend_incomplete_caches(rows)
+                        migration.process_rows(
+                            [ dict(row) for row in rows ], updating=updating)
+                        durations[migration] += time.time() - started
+                        migration.record_batch(rows, time.time() - started)
+            finally:
+                connection.close()
+
+                for migration, check, updating in active:
+                    migration.incomplete_caches = ()
+
+            print("")
+
+            for migration, check, updating in active:
+                started = time.time()
+                if updating:
+                    migration.create_m2m_pairs(skip_existing=True)
+                else:
+                    migration.create_m2m_pairs(
+                        skip_existing=bool(migration.upsert_fields))
+                    migration.hook_after_all()
+                durations[migration] += time.time() - started
+
+        return (current, durations)
+
+
+    @classmethod
+    def iterate_batches(self, cursor, limit=None):
+        """
+        generator over the batches of rows returned by `cursor`, at most
+        `limit` rows
+        """
+        def fetch():
+            remaining = limit
+            while remaining is None or remaining > 0:
+                size = self.batch_size
+                if remaining is not None:
+                    size = min(size, remaining)
+                    remaining -= size
+
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                yield rows
+
+        if self.read_ahead > 0:
+            return iterate_in_background(fetch(), self.read_ahead)
+
+        return fetch()
 
 
 from django.conf import settings
+from django.utils.module_loading import module_has_submodule
+from importlib import import_module
+
+import os
+
+def register(migration):
+    """
+    class decorator which registers the supplied migration explicitly, so it
+    will be migrated by `Migrator` even if it is not defined in
+    a `data_migration_spec` module itself.
+    """
+    return Importer.register(migration)
+
 
 class Importer(object):
     """
@@ -511,46 +2908,157 @@ class Importer(object):
     migrations accross all installed apps
     """
 
+    #: the name of the module in each app, which contains the migrations
+    spec_module = "data_migration_spec"
+
+    # the migrations which have been found or registered explicitly
+    registry = []
+
+    # the number of seconds the last call of `import_all` has taken
+    discovery_time = None
+
     @classmethod
     def installed_apps(self):
         return settings.INSTALLED_APPS
 
     @classmethod
     def possible_existing_migrations(self):
-        return [ app + ".data_migration_spec"
+        return [ app + "." + self.spec_module
             for app in self.installed_apps() ]
 
     @classmethod
-    def import_all(self, excludes=[]):
+    def existing_migrations(self, rediscover=False):
+        """
+        returns the names of all migration specs that exist in the installed
+        apps. If `DATA_MIGRATION_MANIFEST` is set to a file path in your
+        settings, the result is cached in this file until `INSTALLED_APPS`
+        changes or `rediscover` is True.
+        """
+        apps = list(self.installed_apps())
+        manifest = getattr(settings, 'DATA_MIGRATION_MANIFEST', None)
+
+        if manifest and not rediscover and os.path.isfile(manifest):
+            with open(manifest) as f:
+                cached = json.load(f)
+
+            if cached.get('installed_apps') == apps:
+                return cached['specs']
+
+        specs = []
+        for app in apps:
+            try:
+                package = import_module(app)
+            except ImportError:
+                # this is not a package, e.g. the path to an AppConfig
+                continue
+
+            if module_has_submodule(package, self.spec_module):
+                specs.append(app + "." + self.spec_module)
+
+        if manifest:
+            with open(manifest, 'w') as f:
+                json.dump({ 'installed_apps': apps, 'specs': specs }, f)
+
+        return specs
+
+    @classmethod
+    def import_all(self, excludes=[], rediscover=False):
         """
-        this does an `from X import *` for all existing migration specs
+        this imports all existing migration specs and registers the
+        migrations they export, like `from spec import *` would, so
+        migrations defined in other modules and imported into a spec are
+        registered as well. Errors raised by a spec are not caught.
         """
-        for app in self.possible_existing_migrations():
+        started = time.time()
+
+        for spec in self.existing_migrations(rediscover=rediscover):
 
-            matches = [ ex for ex in excludes if ex in app ]
+            matches = [ ex for ex in excludes if ex in spec ]
             if len(matches) > 0:
                 continue
 
-            try:
-                m = __import__(app)
-                try:
-                    attrlist = m.__all__
-                except AttributeError:
-                    attrlist = dir(m)
+            module = import_module(spec)
+            exported = getattr(module, '__all__', None)
+            if exported is None:
+                exported = [ attr for attr in dir(module)
+                    if not attr.startswith('_') ]
+
+            for attr in exported:
+                obj = getattr(module, attr)
+
+                if (inspect.isclass(obj) and issubclass(obj, Migration)
+                        and obj is not Migration):
+                    self.register(obj)
+
+        self.discovery_time = time.time() - started
+
+    @classmethod
+    def register(self, migration):
+        if not (inspect.isclass(migration) and issubclass(migration, Migration)):
+            raise ImproperlyConfigured(
+                'only subclasses of Migration can be registered: %s' % migration)
+
+        if migration not in self.registry:
+            self.registry.append(migration)
+
+        return migration
+
+    @classmethod
+    def migrations(self):
+        """returns all registered migrations"""
+        return list(self.registry)
+
+
+def sample_result(migration, total, processed, failed, duration):
+    """
+    returns the result of sampling the supplied migration with the measured
+    throughput and the runtime that is extrapolated for `total` rows
+    """
+    rate = processed / duration if duration > 0 else None
+    estimate = None
+    if rate and total >= 0:
+        estimate = total / rate
+
+    return { 'migration': migration, 'total': total, 'processed': processed,
+             'failed': failed, 'duration': duration, 'rate': rate,
+             'estimate': estimate }
+
 
-                for attr in attrlist:
-                    globals()[attr] = getattr(m, attr)
+def setup_transform_worker():
+    """
+    sets up Django in a worker process of `transform_workers`, which is
+    necessary if the process has been spawned instead of forked
+    """
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
 
-            except ImportError as e:
-                pass
+
+def transform_in_process(migration, rows):
+    """transforms a batch of rows in a worker process of `transform_in_pool`"""
+    return migration.transform_ahead(rows)
 
 
 class NotCommitBreak(Exception):
     pass
 
 
+class FailureThresholdExceeded(Exception):
+    pass
+
+
+class TransformationFailure(object):
+    """
+    takes the place of a row, where `hook_before_transformation` has failed
+    in the background thread
+    """
+
+    def __init__(self, exception, row):
+        self.exception = exception
+        self.row = row
+
+
 from django.db import transaction
-import networkx as nx
 
 # get the best available context manager for the transaction handling
 atomic = getattr(transaction, "atomic", None)
@@ -558,6 +3066,27 @@ if not atomic:
     atomic = transaction.commit_on_success
 
 
+@contextmanager
+def savepoint():
+    """
+    wraps the block in a savepoint of the current transaction, which is
+    rolled back if the block raises. `atomic` can't be nested on Django < 1.6,
+    as `commit_on_success` would commit the whole run.
+    """
+    if hasattr(transaction, "atomic"):
+        with transaction.atomic():
+            yield
+        return
+
+    sid = transaction.savepoint()
+    try:
+        yield
+    except Exception:
+        transaction.savepoint_rollback(sid)
+        raise
+    transaction.savepoint_commit(sid)
+
+
 class Migrator(object):
     """
     this class encapsulates the migration process for all existing migration
@@ -565,21 +3094,230 @@ class Migrator(object):
     """
 
     @classmethod
-    def migrate(self, commit=False, log_queries=False):
+    def migrate(self, commit=False, log_queries=False, validate=False,
+                sample=None, only=None, upstream=False, downstream=False,
+                max_failures=None, snapshot_dir=None, track_memory=False,
+                memory_report=None, count_queries=False, mute_signals=False,
+                metrics=None, metrics_interval=10.0):
+        """
+        runs all migrations in a transaction, which is only committed if
+        `commit` is True.
+
+        :param validate: only validate the migrations without writing to the
+                         DB. The number of failing rows is returned.
+        :param sample: only migrate the first N rows (int) or a percentage
+                       (e.g. "10%") of each migration and print the
+                       extrapolated runtime. Nothing is committed and the
+                       measurements are returned.
+        :param only: a list of Migration class or model names. Only these
+                     migrations are processed.
+        :param upstream: also process the migrations `only` depends on
+        :param downstream: also process the migrations depending on `only`
+        :param max_failures: put up to this number of failing rows of each
+                             migration into quarantine, unless the migration
+                             defines `max_failures` itself
+        :param snapshot_dir: read the rows from local snapshots in this
+                             directory, see `Migration.snapshot_dir`
+        :param track_memory: record the memory usage of each migration, see
+                             `Migration.track_memory`, and print it at the end
+        :param memory_report: write the recorded memory usage as JSON to this
+                              file after each migration. Implies
+                              `track_memory`.
+        :param count_queries: count the queries issued on the Django database
+                              by each migration, see
+                              `Migration.count_queries`, and print them at
+                              the end
+        :param mute_signals: mute all model signals while the migrations are
+                             migrated, see `Migration.mute_signals`
+        :param metrics: a list of `MetricsSink`, which receive the counters
+                        and gauges of the run every `metrics_interval`
+                        seconds, see `data_migration.metrics.Metrics`
+        """
+        migrations = self.sorted_migrations()
+
+        if only:
+            migrations = self.select_migrations(
+                migrations, only, upstream=upstream, downstream=downstream)
+
+        failed = 0
+        samples = []
+        budgeted = []
+        shared = set()
+
+        if max_failures is not None:
+            budgeted = [ mig for mig in migrations if mig.max_failures is None ]
+
+        snapshotted = migrations if snapshot_dir is not None else []
+
+        track_memory = track_memory or memory_report is not None
+        tracked = migrations if track_memory else []
+        Migration.memory_usage = {}
+
+        counted = migrations if count_queries else []
+        Migration.query_counts = {}
+
+        muted = migrations if mute_signals else []
+        Migration.deferred_relations = {}
+        Migration.quarantined = []
+
+        if validate:
+            self.prepare_validated_index(migrations)
+
+        if sample is not None:
+            limit, percentage = self.parse_sample(sample)
+
+        if metrics:
+            Migration.metrics = Metrics(metrics, interval=metrics_interval)
+
         try:
-            with atomic():
-                for migration in self.sorted_migrations():
+            with atomic(), \
+                    class_attributes(budgeted, max_failures=max_failures), \
+                    class_attributes(snapshotted, snapshot_dir=snapshot_dir), \
+                    class_attributes(tracked, track_memory=True), \
+                    class_attributes(counted, count_queries=True), \
+                    class_attributes(muted, mute_signals=True):
+                for migration in migrations:
 
                     if migration.skip is True:
                         print("%s: will be skipped" % migration)
                         continue
 
                     if log_queries:
-                        print(("Query for %s: " % (migration)) + migration.query)
+                        print(("Query for %s: " % (migration)) + migration.source_query())
+
+                    if Migration.metrics is not None:
+                        Migration.metrics.start(migration)
+
+                    if validate:
+                        failed += migration.validate()
+                    elif migration.shared_source is not None:
+                        # the following migrations of the same source are
+                        # migrated in the same scan
+                        if migration in shared:
+                            continue
+
+                        group = [ mig for mig in migrations if mig.skip is not True
+                                    and mig.shared_source is migration.shared_source ]
+                        if sample is not None:
+                            samples.extend(migration.shared_source.sample(
+                                group, limit, percentage))
+                        else:
+                            migration.shared_source.migrate(group)
+                        shared.update(group)
+
+                        for mig in group:
+                            mig.cleanup_relation_cache()
+                    elif sample is not None:
+                        result = migration.sample(limit, percentage)
+                        if result is not None:
+                            samples.append(result)
+                    else:
+                        migration.migrate()
+                    migration.cleanup_relation_cache()
+
+                    if memory_report is not None:
+                        self.write_memory_report(memory_report)
+
+                if validate:
+                    raise NotCommitBreak("validation only")
+
+                if sample is None:
+                    self.resolve_deferred_relations(migrations)
+
+                if sample is not None:
+                    raise NotCommitBreak("sampling only")
+
+                if not commit:
+                    raise NotCommitBreak("nothing has changed")
+
+        except NotCommitBreak as e:
+            if validate:
+                sys.stderr.write(
+                    "\nValidation finished with %d failing rows. "
+                    "No changes have been made to the DB.\n" % failed)
+            elif sample is not None:
+                self.print_sample_report(samples)
+            else:
+                sys.stderr.write(
+                    "\nNot commiting! No changes have been made to the DB.\n"
+                    "Pass --commit to write your changes on success.\n")
+
+        except FailureThresholdExceeded:
+            # keep the failing rows, which have been rolled back with the run
+            if commit:
+                QuarantinedRow.objects.bulk_create([ QuarantinedRow(
+                    classname=entry.classname, row=entry.row,
+                    exception=entry.exception) for entry in Migration.quarantined ])
+            raise
+
+        finally:
+            Migration.validated_index = {}
+            Migration.deferred_relations = {}
+            Migration.quarantined = []
+
+            # the count queries must not outlive the run
+            for call in Migration.row_counts.values():
+                call.wait()
+            Migration.row_counts = {}
+
+            if Migration.metrics is not None:
+                Migration.metrics.close()
+                Migration.metrics = None
+
+        if Migration.memory_usage:
+            self.print_memory_report()
+
+        if Migration.query_counts:
+            self.print_query_report()
+
+        return samples if sample is not None else failed
+
+
+    @classmethod
+    def replay_quarantine(self, commit=False):
+        """
+        migrates the quarantined rows again. Rows, which are migrated
+        successfully, are removed from the quarantine.
+
+        returns the number of rows which are still failing
+        """
+        migrations = self.sorted_migrations()
+        replayed = 0
+        failed = 0
+        Migration.deferred_relations = {}
+
+        try:
+            with atomic(), class_attributes(migrations, max_failures=None):
+                for migration in migrations:
+                    quarantined = QuarantinedRow.objects.filter(
+                        classname=str(migration)).order_by('pk')
+
+                    if not quarantined.exists():
+                        continue
+
+                    print("Replaying quarantined rows of %s" % migration)
+
+                    for entry in quarantined:
+                        try:
+                            with savepoint():
+                                migration.create_instance_from_row(
+                                    decode_row(entry.row))
+                        except Exception as e:
+                            failed += 1
+                            entry.exception = "%s: %s" % (
+                                e.__class__.__name__, e)
+                            entry.save()
+                        else:
+                            replayed += 1
+                            entry.delete()
 
-                    migration.migrate()
                     migration.cleanup_relation_cache()
 
+                self.resolve_deferred_relations(migrations)
+
+                print("%d rows replayed, %d rows still failing" % (
+                    replayed, failed))
+
                 if not commit:
                     raise NotCommitBreak("nothing has changed")
 
@@ -588,11 +3326,317 @@ class Migrator(object):
                 "\nNot commiting! No changes have been made to the DB.\n"
                 "Pass --commit to write your changes on success.\n")
 
+        return failed
+
+
+    @classmethod
+    def resolve_deferred_relations(self, migrations):
+        """
+        resolves the deferred relations of the supplied migrations, when all
+        of them have been migrated
+        """
+        for migration in migrations:
+            if migration.deferred_columns():
+                migration.resolve_deferred_relations()
+                migration.cleanup_relation_cache()
+
+
+    @classmethod
+    def follow(self, interval=5.0, only=None, cycles=None, metrics=None,
+               metrics_interval=10.0):
+        """
+        applies the changes of the legacy DB with `Migration.sync` every
+        `interval` seconds for each migration with a `change_marker`, until
+        it is interrupted or `cycles` polls have been made. Each batch of
+        changes is committed on its own. The metrics are exported like in
+        `migrate`, including the lag of each migration.
+
+        returns the number of applied rows
+        """
+        migrations = self.sorted_migrations()
+        if only:
+            migrations = self.select_migrations(migrations, only)
+
+        following = []
+        for migration in migrations:
+            if migration.skip is True:
+                continue
+            if not migration.change_marker:
+                print("%s: can not be followed without `change_marker`" % migration)
+                continue
+
+            migration.check_migration()
+            following.append(migration)
+
+        applied = 0
+        cycle = 0
+
+        if metrics:
+            Migration.metrics = Metrics(metrics, interval=metrics_interval)
+
+        try:
+            while cycles is None or cycle < cycles:
+                cycle += 1
+                started = time.time()
+                Migration.deferred_relations = {}
+
+                for migration in following:
+                    if Migration.metrics is not None:
+                        Migration.metrics.start(migration)
+
+                    result = migration.sync()
+                    migration.cleanup_relation_cache()
+
+                    if result['rows']:
+                        applied += result['rows']
+                        print("%s: %d rows applied up to %s, lag %s" % (
+                            migration, result['rows'], result['marker'],
+                            format_duration(result['lag'])))
+
+                if cycles is None or cycle < cycles:
+                    time.sleep(max(0, interval - (time.time() - started)))
+        finally:
+            if Migration.metrics is not None:
+                Migration.metrics.close()
+                Migration.metrics = None
+
+        return applied
+
+
+    @classmethod
+    def verify(self, only=None, chunk_size=1000):
+        """
+        compares the rows of the legacy DB with the migrated instances for
+        each migration with a `search_attr`, see `Migration.verify`, and
+        prints the differing ranges of keys.
+
+        returns the results of all compared migrations
+        """
+        migrations = self.sorted_migrations()
+        if only:
+            migrations = self.select_migrations(migrations, only)
+
+        results = []
+        for migration in migrations:
+            if migration.skip is True or migration.search_attr is None:
+                print("%s: can not be verified without `search_attr`" % migration)
+                continue
+
+            result = migration.verify(chunk_size=chunk_size)
+            results.append(result)
+
+            print("%s: %d source rows, %d target rows, %d differing ranges" % (
+                migration, result['source'], result['target'],
+                len(result['differences'])))
+
+            for first, last, source, target in result['differences']:
+                print("  %s %s..%s: %d source rows, %d target rows" % (
+                    migration.search_attr, "" if first is None else first,
+                    "" if last is None else last, source, target))
+
+        return results
+
+
+    @classmethod
+    def select_migrations(self, migrations, names, upstream=False,
+                          downstream=False):
+        """
+        returns the supplied migrations, which match one of `names` or (if
+        requested) are up- or downstream dependencies of them, in their
+        original order.
+
+        A name matches the name of the Migration class, the name of its model
+        or "<app_label>.<model>" (case-insensitive).
+        """
+        selected = set()
+        for name in names:
+            matching = [ mig for mig in migrations
+                            if name.lower() in self.migration_names(mig) ]
+            if not matching:
+                raise ValueError("There is no migration matching '%s'" % name)
+            selected.update(matching)
+
+        by_model = dict( (mig.model, mig) for mig in migrations )
+
+        def closure(start, neighbours):
+            found = set()
+            todo = list(start)
+            while todo:
+                for mig in neighbours(todo.pop()):
+                    if mig not in found:
+                        found.add(mig)
+                        todo.append(mig)
+            return found
+
+        closed = set(selected)
+        if upstream:
+            closed |= closure(selected, lambda mig: [
+                by_model[model] for model in mig.dependencies() if model in by_model ])
+        if downstream:
+            closed |= closure(selected, lambda mig: [
+                other for other in migrations if mig.model in other.dependencies() ])
+
+        return [ mig for mig in migrations if mig in closed ]
+
+
+    @classmethod
+    def migration_names(self, migration):
+        """returns the lowercased names a migration can be selected by"""
+        meta = migration.model._meta
+        return [ name.lower() for name in (
+            migration.__name__, meta.object_name,
+            "%s.%s" % (meta.app_label, meta.object_name)) ]
+
+
+    @classmethod
+    def parse_sample(self, sample):
+        """
+        parses the sample size, which can be a number of rows or a percentage
+        like "10%". returns a tuple of (limit, percentage)
+        """
+        value = str(sample).strip()
+
+        try:
+            if value.endswith('%'):
+                percentage = float(value[:-1])
+                if 0 < percentage <= 100:
+                    return (None, percentage)
+            else:
+                limit = int(value)
+                if limit > 0:
+                    return (limit, None)
+        except ValueError:
+            pass
+
+        raise ValueError(
+            "invalid sample size '%s', use a number of rows or a percentage "
+            "like '10%%'" % sample)
+
+
+    @classmethod
+    def print_sample_report(self, samples):
+        """prints the extrapolated runtime for each sampled migration"""
+        print("\nEstimated runtime based on the sampled rows:")
+
+        for result in samples:
+            rate = result['rate']
+            print("  %s: %d rows (%d failed) in %.2fs, %s rows/s, "
+                  "%s for %s rows" % (
+                    result['migration'], result['processed'], result['failed'],
+                    result['duration'], "%.1f" % rate if rate else "unknown",
+                    format_duration(result['estimate']),
+                    result['total'] if result['total'] >= 0 else "unknown"))
+
+        estimates = [ r['estimate'] for r in samples ]
+        if None in estimates:
+            total = None
+        else:
+            total = sum(estimates)
+
+        print("Estimated total runtime: %s" % format_duration(total))
+        sys.stderr.write(
+            "\nSampling only! No changes have been made to the DB.\n")
+
+
+    @classmethod
+    def print_memory_report(self):
+        """prints the memory usage recorded for each migration"""
+        megabytes = lambda value: "%.1f MB" % (value / 1048576.0) \
+            if value is not None else "unknown"
+
+        print("\nMemory usage:")
+        for name, usage in sorted(Migration.memory_usage.items()):
+            print("  %s: peak RSS %s (+%s), traced %s (peak %s)" % (
+                name, megabytes(usage['peak_rss']),
+                megabytes(usage['rss_growth']),
+                megabytes(usage['traced_delta']),
+                megabytes(usage['traced_peak'])))
+
+            for klass, cache in sorted(usage['relation_caches'].items()):
+                print("    relation cache %s: %d entries, %s" % (
+                    klass, cache['entries'], megabytes(cache['bytes'])))
+
+
+    @classmethod
+    def print_query_report(self):
+        """prints the queries counted for each migration by phase"""
+        print("\nQueries on the Django database:")
+        for name, counts in sorted(Migration.query_counts.items()):
+            phases = ", ".join("%s %d" % (phase, number) for phase, number
+                                in sorted(counts['phases'].items()))
+            print("  %s: %d queries for %d rows (%s)" % (
+                name, counts['total'], counts['rows'] or 0, phases or "none"))
+
+
+    @classmethod
+    def write_memory_report(self, path):
+        """writes the memory usage recorded for each migration to `path`"""
+        with open(path, 'w') as f:
+            json.dump(Migration.memory_usage, f, indent=2, sort_keys=True)
+
+
+    @classmethod
+    def prepare_validated_index(self, migrations):
+        """
+        creates an empty entry in the `validated_index` for every relation
+        which is described by one of the supplied migrations
+        """
+        index = {}
+        for migration in migrations:
+            for desc in migration.column_description.values():
+                if not desc['exclude']:
+                    index[(desc['klass'], desc['attr'])] = {}
+
+        Migration.validated_index = index
+
 
     @classmethod
     def sorted_migrations(self):
-        return self.sort_based_on_dependency(
-            [ mig for mig in itersubclasses(Migration) if mig.query ])
+        migrations = Importer.migrations()
+
+        return self.group_shared_sources(self.sort_based_on_dependency(
+            [ mig for mig in migrations if mig.source_query() ]))
+
+
+    @classmethod
+    def group_shared_sources(self, migrations):
+        """
+        returns the supplied migrations, which have to be in dependency order,
+        in a dependency order, where the migrations of each `SharedSource`
+        follow each other, so they can be migrated in a single scan.
+        Otherwise the supplied order is kept.
+        """
+        unit = lambda mig: mig.shared_source or mig
+        by_model = dict( (mig.model, mig) for mig in migrations )
+        units = []
+        members = {}
+
+        for mig in migrations:
+            if unit(mig) not in members:
+                units.append(unit(mig))
+            members.setdefault(unit(mig), []).append(mig)
+
+        requires = dict( (key, set( unit(by_model[model]) for mig in members[key]
+                                        for model in mig.dependencies()
+                                        if model in by_model ) - set([key]))
+                            for key in units )
+
+        ordered = []
+        finished = set()
+
+        while units:
+            ready = [ key for key in units if requires[key] <= finished ]
+            if not ready:
+                raise ImproperlyConfigured(
+                    "The migrations of %s can not be migrated in a single "
+                    "scan because of cyclic dependencies" % ", ".join(
+                        str(key) for key in units))
+
+            units.remove(ready[0])
+            finished.add(ready[0])
+            ordered.extend(members[ready[0]])
+
+        return ordered
 
 
     @classmethod
@@ -608,6 +3652,9 @@ class Migrator(object):
             """
             does a topological sort on the supplied edges http://goo.gl/lkOt1
             """
+            # networkx is imported here as it takes a while to be imported
+            import networkx as nx
+
             G = nx.DiGraph()
             for path in edges:
                 G.add_nodes_from(path)
@@ -616,7 +3663,7 @@ class Migrator(object):
 
 
         # get a migratable order of models which are specified in the migrations
-        dependency_graphs = [ mig.depends_on + [ mig.model ]
+        dependency_graphs = [ mig.dependencies() + [ mig.model ]
                                 for mig in classes ]
 
         ordered_models = topological_sort(dependency_graphs)
@@ -635,4 +3682,93 @@ class Migrator(object):
                 raise AttributeError(
                     "InvalidState: '%s' has more than one migration" % model)
 
-        return ordered_migrations
+        # start the migrations with the longest critical path first
+        return [ entry['migration'] for entry in
+                    self.schedule(ordered_migrations, workers=1) ]
+
+
+    @classmethod
+    def recorded_durations(self, classes):
+        """
+        returns a dict with the duration of the last recorded run for each of
+        the supplied migrations, which has been migrated before
+        """
+        names = dict( (str(cla), cla) for cla in classes )
+        durations = {}
+
+        for run in MigrationRun.objects.filter(
+                classname__in=list(names)).order_by('migrated_at', 'pk'):
+            durations[names[run.classname]] = run.duration
+
+        return durations
+
+
+    @classmethod
+    def schedule(self, ordered_migrations, workers=1):
+        """
+        schedules the supplied migrations, which have to be in a valid
+        dependency order, on `workers` parallel workers. Migrations with the
+        longest critical path (based on the recorded durations) are started
+        first. Migrations without a recorded duration are expected to take
+        no time, so without any history the supplied order is kept.
+
+        returns a list of dicts with the keys `migration`, `worker`, `start`
+        and `end` (the estimated seconds since the start of the run), sorted
+        by the start of each migration
+        """
+        durations = self.recorded_durations(ordered_migrations)
+        position = dict( (mig, i) for i, mig in enumerate(ordered_migrations) )
+        by_model = dict( (mig.model, mig) for mig in ordered_migrations )
+
+        requires = dict(
+            (mig, set(by_model[m] for m in mig.dependencies() if m in by_model))
+                for mig in ordered_migrations )
+
+        # the critical path is the longest chain of durations, which starts
+        # with a migration
+        critical = {}
+        for mig in reversed(ordered_migrations):
+            critical[mig] = durations.get(mig, 0.0) + max([ critical[other]
+                for other in ordered_migrations if mig in requires[other] ] + [0.0])
+
+        finished = set()
+        running = []
+        free = list(range(workers))
+        scheduled = []
+        now = 0.0
+
+        while len(scheduled) < len(ordered_migrations):
+            started = set( entry['migration'] for entry in scheduled )
+            ready = [ mig for mig in ordered_migrations
+                        if mig not in started and requires[mig] <= finished ]
+            ready.sort(key=lambda mig: (-critical[mig], position[mig]))
+
+            for mig in ready[:len(free)]:
+                entry = { 'migration': mig, 'worker': free.pop(0),
+                          'start': now, 'end': now + durations.get(mig, 0.0) }
+                scheduled.append(entry)
+                running.append(entry)
+
+            # wait until the next migration has been finished
+            running.sort(key=lambda e: (e['end'], position[e['migration']]))
+            entry = running.pop(0)
+            now = entry['end']
+            finished.add(entry['migration'])
+            free.append(entry['worker'])
+            free.sort()
+
+        return scheduled
+
+
+    @classmethod
+    def print_schedule(self, workers):
+        """prints the estimated schedule of all migrations for `workers`"""
+        schedule = self.schedule(self.sorted_migrations(), workers=workers)
+
+        for entry in schedule:
+            print("worker %d: %s -> %s  %s" % (
+                entry['worker'] + 1, format_duration(entry['start']),
+                format_duration(entry['end']), entry['migration']))
+
+        print("Estimated total runtime with %d workers: %s" % (
+            workers, format_duration(max([ e['end'] for e in schedule ] + [0]))))
@@ -5,3 +5,24 @@ class AppliedMigration(models.Model):
     """Model that holds information about applied migrations"""
     classname = models.CharField(max_length=100)
     migrated_at = models.DateTimeField(auto_now_add=True)
+
+class MigrationRun(models.Model):
+    """Model that holds the duration and row count of each migration run"""
+    classname = models.CharField(max_length=255, db_index=True)
+    migrated_at = models.DateTimeField(auto_now_add=True)
+    duration = models.FloatField()
+    rows = models.IntegerField()
+
+class QuarantinedRow(models.Model):
+    """Model that holds a row which has failed during a migration"""
+    classname = models.CharField(max_length=255, db_index=True)
+    quarantined_at = models.DateTimeField(auto_now_add=True)
+    row = models.TextField()
+    exception = models.TextField()
+
+class SyncMarker(models.Model):
+    """Model that holds the change marker up to which a migration is synced"""
+    classname = models.CharField(max_length=255, unique=True)
+    value = models.TextField()
+    keys = models.TextField(default='[]')
+    synced_at = models.DateTimeField(auto_now=True)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import gzip
+import hashlib
+import json
+import os
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+class Snapshot(object):
+    """
+    A local copy of the result of a query, which is used instead of the
+    legacy DB. The rows are stored as a gzipped stream of pickled chunks,
+    so they can be read without loading the whole result into memory. The
+    metadata (columns, row count and a hash of the query) is stored in a
+    separate JSON file.
+    """
+
+    def __init__(self, directory, name):
+        self.data_path = os.path.join(directory, name + ".pickle.gz")
+        self.meta_path = os.path.join(directory, name + ".json")
+
+    @staticmethod
+    def query_hash(query):
+        if not isinstance(query, bytes):
+            query = query.encode('utf-8')
+        return hashlib.sha1(query).hexdigest()
+
+    def metadata(self):
+        with open(self.meta_path) as f:
+            return json.load(f)
+
+    def is_current(self, query):
+        """checks if the snapshot exists and has been created for `query`"""
+        if not (os.path.isfile(self.meta_path) and
+                    os.path.isfile(self.data_path)):
+            return False
+
+        return self.metadata()['query'] == self.query_hash(query)
+
+    def create(self, connection, query, chunk_size):
+        """executes `query` on `connection` and stores the result"""
+        directory = os.path.dirname(self.data_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        cursor = connection.cursor()
+        cursor.execute(query)
+        columns = [ column[0] for column in cursor.description ]
+        rowcount = 0
+
+        # write to temporary files, so an incomplete snapshot is never used
+        with gzip.open(self.data_path + ".tmp", 'wb') as f:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+
+                chunk = [ [ row[column] for column in columns ] for row in rows ]
+                pickle.dump(chunk, f, 2)
+                rowcount += len(rows)
+
+        with open(self.meta_path + ".tmp", 'w') as f:
+            json.dump({ 'query': self.query_hash(query), 'columns': columns,
+                        'rowcount': rowcount }, f)
+
+        os.rename(self.data_path + ".tmp", self.data_path)
+        os.rename(self.meta_path + ".tmp", self.meta_path)
+
+    def connect(self):
+        return SnapshotConnection(self)
+
+
+class SnapshotConnection(object):
+    """DB-API like connection, which reads the rows from a `Snapshot`"""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def cursor(self):
+        return SnapshotCursor(self.snapshot)
+
+    def close(self):
+        pass
+
+
+class SnapshotCursor(object):
+    """DB-API like cursor, which returns the rows of a `Snapshot` as dicts"""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.file = None
+        self.buffer = []
+
+        metadata = snapshot.metadata()
+        self.query = metadata['query']
+        self.columns = metadata['columns']
+        self.rowcount = metadata['rowcount']
+        self.description = [ (column, None, None, None, None, None, None)
+                                for column in self.columns ]
+
+    def execute(self, query, params=None):
+        if Snapshot.query_hash(query) != self.query:
+            raise ValueError("the snapshot has been created for another query")
+
+        self.close()
+        self.buffer = []
+        self.file = gzip.open(self.snapshot.data_path, 'rb')
+
+    def fetchmany(self, size=1000):
+        while len(self.buffer) < size and self.file is not None:
+            try:
+                self.buffer.extend(pickle.load(self.file))
+            except EOFError:
+                self.close()
+
+        rows, self.buffer = self.buffer[:size], self.buffer[size:]
+        return [ dict(zip(self.columns, row)) for row in rows ]
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchall(self):
+        rows = []
+        while True:
+            chunk = self.fetchmany()
+            if not chunk:
+                return rows
+            rows.extend(chunk)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -11,7 +11,8 @@ class BaseMigration(Migration):
     @classmethod
     def open_db_connection(self):
         conn = sqlite3.connect(
-                    os.path.join(os.path.dirname(__file__), 'blog_fixture.db'))
+                    os.path.join(os.path.dirname(__file__), 'blog_fixture.db'),
+                    check_same_thread=False)
 
         def dict_factory(cursor, row):
             d = {}
@@ -19,3 +19,6 @@ class Post(models.Model):
     posted = models.DateTimeField(db_index=True, auto_now_add=True)
     author = models.ForeignKey(Author)
     comments = models.ManyToManyField(Comment, related_name="post")
+
+class Node(models.Model):
+    parent = models.ForeignKey('self', null=True)
@@ -0,0 +1,2 @@
+from data_migration.migration import Migration
+from data_migration.test_apps.blog.models import NotExistingModel
@@ -0,0 +1 @@
+from .migrations import *
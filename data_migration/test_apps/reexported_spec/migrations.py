@@ -0,0 +1,6 @@
+from data_migration.migration import Migration
+from django.contrib.auth.models import User
+
+class ProfileMigration(Migration):
+    query = "SELECT * FROM users;"
+    model = User
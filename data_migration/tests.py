@@ -2,17 +2,23 @@
 from __future__ import unicode_literals
 from future.builtins import str
 
+from django import VERSION as DJANGO_VERSION
 from django.test import TestCase, TransactionTestCase
-from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
 from django.conf import settings
 from django.contrib.auth.models import User, Group
 
 from mock import patch
 from io import StringIO
 
-from .models import AppliedMigration
-from .migration import is_a, Migration, Importer, Migrator
+from .metrics import JsonLinesSink, PrometheusTextfileSink
+from .models import AppliedMigration, MigrationRun, QuarantinedRow, SyncMarker
+from .utils import BackgroundCall, MemoryTracker, QueryCounter, columnar, approximate_size
+from .migration import is_a, register, Migration, Importer, Migrator, \
+    FailureThresholdExceeded, SharedSource
 
+import json
+import os
 import sys
 
 """
@@ -27,7 +33,8 @@ def install_apps(apps):
 
     def real_decorator(function):
         def wrapper(*args, **kwargs):
-            with patch.object(Importer, 'installed_apps') as method:
+            with patch.object(Importer, 'installed_apps') as method, \
+                    patch.object(Importer, 'registry', []):
                 method.return_value = apps
                 function(*args, **kwargs)
 
@@ -42,14 +49,13 @@ def run_migrations(*migrations):
     """
     def real_decorator(function):
         def wrapper(*args, **kwargs):
-            with patch.object(Migration, '__subclasses__') as method:
+            with patch.object(Importer, 'registry', list(migrations)):
 
                 # cleanup relation caches as it could be compromised by
                 # previous tests
                 for mig in migrations:
                     mig.cleanup_relation_cache()
 
-                method.return_value = migrations
                 function(*args, **kwargs)
         return wrapper
     return real_decorator
@@ -67,8 +73,59 @@ class ImporterTest(TestCase):
 
         self.assertEqual(new_count - old_count, 1)
 
+    @install_apps(['valid_a', 'valid_b', 'missing_spec'])
+    def test_registry_contains_migrations_of_the_specs(self):
+        from .test_apps.valid_a.data_migration_spec import UserMigration
+
+        Importer.import_all(excludes=["valid_b"])
+
+        self.assertEqual(Importer.migrations(), [UserMigration])
+        self.assertTrue(Importer.discovery_time >= 0)
+
+    @install_apps(['reexported_spec'])
+    def test_migrations_imported_into_a_spec_are_registered(self):
+        from .test_apps.reexported_spec.migrations import ProfileMigration
+
+        Importer.import_all()
+
+        self.assertEqual(Importer.migrations(), [ProfileMigration])
+
+    @install_apps(['broken_spec'])
+    def test_errors_in_specs_are_not_swallowed(self):
+        with self.assertRaises(ImportError):
+            Importer.import_all()
+
+    @install_apps(['valid_a', 'missing_spec'])
+    def test_discovered_specs_are_cached_in_manifest(self):
+        import tempfile
+        manifest = tempfile.mktemp()
+
+        with self.settings(DATA_MIGRATION_MANIFEST=manifest):
+            specs = Importer.existing_migrations()
+            self.assertEqual(specs,
+                ["data_migration.test_apps.valid_a.data_migration_spec"])
 
-from .test_apps.blog.models import Author, Post, Comment
+            with patch('data_migration.migration.module_has_submodule') as has:
+                self.assertEqual(Importer.existing_migrations(), specs)
+                self.assertFalse(has.called)
+
+                Importer.existing_migrations(rediscover=True)
+                self.assertTrue(has.called)
+
+        os.unlink(manifest)
+
+    @patch.object(Importer, 'registry', [])
+    def test_explicit_registration(self):
+        from .test_apps.valid_b.data_migration_spec import GroupMigration
+
+        self.assertEqual(register(GroupMigration), GroupMigration)
+        self.assertEqual(Importer.migrations(), [GroupMigration])
+
+        with self.assertRaises(ImproperlyConfigured):
+            register(Group)
+
+
+from .test_apps.blog.models import Author, Post, Comment, Node
 from .test_apps.blog.data_migration_spec import *
 
 class MigratorTest(TransactionTestCase):
@@ -92,6 +149,43 @@ class MigratorTest(TransactionTestCase):
         self.assertEqual(_sorted[2].model, Post)
 
 
+    def test_scheduling_based_on_recorded_durations(self):
+        from .test_apps.valid_a.data_migration_spec import UserMigration
+        from .test_apps.valid_b.data_migration_spec import GroupMigration
+
+        for migration, duration in [(AuthorMigration, 1), (UserMigration, 5),
+                                    (GroupMigration, 5)]:
+            MigrationRun.objects.create(
+                classname=str(migration), duration=duration, rows=1)
+
+        _sorted = Migrator.sort_based_on_dependency(
+                    [AuthorMigration, UserMigration, GroupMigration])
+        self.assertEqual(_sorted,
+                         [UserMigration, GroupMigration, AuthorMigration])
+
+        schedule = Migrator.schedule(_sorted, workers=2)
+        self.assertEqual([ (e['migration'], e['start']) for e in schedule ],
+            [(UserMigration, 0), (AuthorMigration, 0), (GroupMigration, 5)])
+        self.assertEqual(max(e['end'] for e in schedule), 10)
+
+
+    def test_selecting_migrations_with_dependencies(self):
+        migrations = [AuthorMigration, CommentMigration, PostMigration]
+        select = lambda *names, **kw: Migrator.select_migrations(
+                    migrations, names, **kw)
+
+        self.assertEqual(select('CommentMigration'), [CommentMigration])
+        self.assertEqual(select('blog.comment', upstream=True),
+                         [AuthorMigration, CommentMigration])
+        self.assertEqual(select('Comment', downstream=True),
+                         [CommentMigration, PostMigration])
+        self.assertEqual(select('Author', 'Post'),
+                         [AuthorMigration, PostMigration])
+
+        with self.assertRaises(ValueError):
+            select('Unknown')
+
+
     @patch.object(Migrator, 'sorted_migrations')
     @patch('sys.stderr', new_callable=StringIO)
     def test_transaction_handling(self, stderr, sorted_migrations):
@@ -120,7 +214,10 @@ class IsATest(TestCase):
             'exclude': False,
             'fk': True,
             'prefetch': True,
-            'assign_by_id': False
+            'assign_by_id': False,
+            'pairs_query': None,
+            'owner_attr': None,
+            'deferred': False
         })
 
     def test_that_class_and_attr_has_to_be_present(self):
@@ -146,7 +243,10 @@ class IsATest(TestCase):
             'exclude': True,
             'fk': False,
             'prefetch': True,
-            'assign_by_id': False
+            'assign_by_id': False,
+            'pairs_query': None,
+            'owner_attr': None,
+            'deferred': False
         })
 
     def test_performance_options(self):
@@ -203,6 +303,297 @@ class MigrationTest(TransactionTestCase):
         self.assertEqual(post9.posted, datetime(2014, 10, 13, 8, 36, 59))
 
 
+    @run_migrations(AuthorMigration, PostMigration, CommentMigration)
+    @patch('sys.stderr', new_callable=StringIO)
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_validation_does_not_write(self, stdout, stderr):
+        failed = Migrator.migrate(validate=True)
+
+        self.assertEqual(failed, 0)
+        self.assertEqual(Author.objects.count(), 0)
+        self.assertEqual(Post.objects.count(), 0)
+        self.assertEqual(AppliedMigration.objects.count(), 0)
+        self.assertTrue("Validating element 10/" in stdout.getvalue())
+        self.assertTrue("0 failing rows" in stderr.getvalue())
+
+
+    @run_migrations(AuthorMigration, CommentMigration)
+    @patch.object(CommentMigration, 'hook_before_save')
+    @patch('sys.stderr', new_callable=StringIO)
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_validation_reports_failing_rows(self, stdout, stderr, hook):
+        hook.side_effect = lambda instance, row: raise_(ValueError("broken"))
+
+        failed = Migrator.migrate(validate=True)
+
+        self.assertEqual(failed, 20)
+        self.assertEqual(Comment.objects.count(), 0)
+        self.assertTrue("ValueError: broken" in stderr.getvalue())
+
+
+    @run_migrations(AuthorMigration, CommentMigration)
+    @patch.object(CommentMigration, 'count_strategy', 'cursor')
+    @patch.object(AuthorMigration, 'hook_row_count')
+    @patch('sys.stderr', new_callable=StringIO)
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_sampling_extrapolates_runtime(self, stdout, stderr, hook):
+        hook.side_effect = lambda conn, cursor: 10
+
+        author, comment = Migrator.migrate(commit=True, sample=5)
+
+        self.assertEqual(Author.objects.count(), 0)
+        self.assertEqual(AppliedMigration.objects.count(), 0)
+        self.assertEqual(author['processed'], 5)
+        self.assertTrue(author['estimate'] is not None)
+        self.assertEqual(comment['estimate'], None)
+        self.assertTrue("Estimated total runtime: unknown" in stdout.getvalue())
+
+        # the row count of comments is unknown
+        with self.assertRaises(ImproperlyConfigured):
+            Migrator.migrate(sample="50%")
+
+        with self.assertRaises(ValueError):
+            Migrator.migrate(sample="0")
+
+
+    @run_migrations(AuthorMigration)
+    @patch.multiple(AuthorMigration, bulk_insert=True, batch_size=2)
+    @patch.object(AuthorMigration, 'bulk_write', wraps=AuthorMigration.bulk_write)
+    @patch('sys.stderr', new_callable=StringIO)
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_sampling_uses_the_write_path(self, stdout, stderr, bulk_write):
+        with patch.object(AuthorMigration, 'execute_query',
+                          wraps=AuthorMigration.execute_query) as execute:
+            author, = Migrator.migrate(sample=5)
+
+        self.assertEqual(execute.call_count, 1)
+        self.assertEqual(author['processed'], 5)
+        self.assertEqual(author['total'], 10)
+        # 5 rows in batches of 2
+        self.assertEqual(bulk_write.call_count, 3)
+        self.assertEqual(Author.objects.count(), 0)
+        self.assertEqual(MigrationRun.objects.count(), 0)
+
+        # without `max_failures` the first failing row ends the sample
+        hook_before_save = AuthorMigration.hook_before_save
+        def before_save(instance, row):
+            if row['id'] == 3:
+                raise ValueError("broken")
+            return hook_before_save(instance, row)
+
+        with patch.object(AuthorMigration, 'hook_before_save',
+                          side_effect=before_save):
+            author, = Migrator.migrate(sample=5)
+
+        self.assertEqual(author['failed'], 1)
+        self.assertEqual(author['processed'], 2)
+        self.assertTrue("Sampling %s has failed" % AuthorMigration
+                        in stderr.getvalue())
+
+        class AuthorSource(SharedSource):
+            query = "SELECT id, Firstname as firstname FROM authors"
+            batch_size = 2
+
+            @classmethod
+            def open_db_connection(self):
+                return BaseMigration.open_db_connection()
+
+        class SharedAuthorMigration(AuthorMigration):
+            shared_source = AuthorSource
+            query = None
+            column_description = {}
+            bulk_insert = False
+
+            @classmethod
+            def hook_before_transformation(self, row):
+                row['lastname'] = row['email'] = ""
+
+        with patch.object(Importer, 'registry', [ SharedAuthorMigration ]):
+            author, = Migrator.migrate(sample="50%")
+
+        self.assertEqual(author['migration'], SharedAuthorMigration)
+        self.assertEqual(author['processed'], 5)
+        self.assertEqual(author['total'], 10)
+        self.assertEqual(author['failed'], 0)
+        self.assertEqual(Author.objects.count(), 0)
+
+
+    @run_migrations(AuthorMigration, CommentMigration)
+    @patch('sys.stderr', new_callable=StringIO)
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_rows_are_counted_automatically(self, stdout, stderr):
+        self.assertEqual(AuthorMigration.count_rows(), 10)
+
+        author, comment = Migrator.migrate(sample="50%")
+        self.assertEqual(author['total'], 10)
+        self.assertEqual(comment['total'], 20)
+        self.assertEqual(comment['processed'], 10)
+        # the counts are cached for a single run
+        self.assertEqual(Migration.row_counts, {})
+
+        with patch.object(AuthorMigration, 'count_strategy', 'cursor'):
+            Migrator.migrate(commit=True)
+            self.assertTrue("1/-1" in stdout.getvalue())
+
+
+    @run_migrations(AuthorMigration, CommentMigration, PostMigration)
+    @patch.multiple(CommentMigration, batch_size=3, read_ahead=2,
+                    transform_in_reader=True)
+    @patch.multiple(PostMigration, batch_size=4, read_ahead=1)
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_reading_ahead_in_background(self, stdout):
+        Migrator.migrate(commit=True)
+
+        self.assertEqual(Comment.objects.count(), 20)
+        self.assertEqual(Post.objects.count(), 10)
+        self.assertEqual(Post.objects.get(id=9).comments.count(), 3)
+
+
+    @run_migrations(AuthorMigration, CommentMigration)
+    @patch.multiple(CommentMigration, batch_size=2, target_batch_latency=60,
+                    min_batch_size=1)
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_adaptive_batch_size(self, stdout):
+        Migrator.migrate(commit=True)
+
+        self.assertEqual(Comment.objects.count(), 20)
+        # the fast batches grow gradually
+        self.assertEqual(Migration.batch_sizes[str(CommentMigration)],
+                         [2, 4, 8, 6])
+        self.assertEqual(CommentMigration.current_batch_size, None)
+
+        rows = [ { 'id': 1, 'message': 'x' * 1000 } ] * 5
+        with patch.multiple(CommentMigration, current_batch_size=5,
+                max_batch_memory=2 * approximate_size(rows[0]) + 1):
+            CommentMigration.adapt_batch_size(rows, 100.0)
+            # 3 rows because of the latency, 2 because of their size
+            self.assertEqual(CommentMigration.current_batch_size, 2)
+
+
+    @run_migrations(AuthorMigration, CommentMigration)
+    @patch.multiple(CommentMigration, batch_size=3, transform_processes=2)
+    @patch.object(CommentMigration, 'hook_before_transformation')
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_transforming_in_worker_processes(self, stdout, hook):
+        def transform(row):
+            row['message'] = "%d: %s" % (os.getpid(), row['id'])
+        hook.side_effect = transform
+
+        # the workers are forked before the count thread is started
+        execute_query = CommentMigration.execute_query
+        def started_first(connection):
+            self.assertTrue(CommentMigration.transform_pool is not None)
+            return execute_query(connection)
+
+        with patch.object(CommentMigration, 'execute_query',
+                          side_effect=started_first):
+            Migrator.migrate(commit=True)
+
+        self.assertEqual(CommentMigration.transform_pool, None)
+        self.assertEqual(Comment.objects.count(), 20)
+        self.assertFalse(hook.called) # it has been called by the workers
+        messages = dict(Comment.objects.values_list('id', 'message'))
+        self.assertTrue(all(message.endswith(": %d" % pk)
+                            for pk, message in messages.items()))
+        self.assertFalse(any(message.startswith("%d:" % os.getpid())
+                             for message in messages.values()))
+
+
+    @run_migrations(AuthorMigration, CommentMigration)
+    @patch.multiple(CommentMigration, read_ahead=2, transform_in_reader=True)
+    @patch.object(CommentMigration, 'hook_error_creating_instance')
+    @patch.object(CommentMigration, 'hook_before_transformation')
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_transformation_errors_in_background(self, stdout, hook, error):
+        hook.side_effect = lambda row: raise_(ValueError())
+        error.side_effect = None
+
+        Migrator.migrate(commit=True)
+
+        self.assertEqual(error.call_count, 20)
+        self.assertEqual(Comment.objects.count(), 0)
+        exception, row = error.call_args[0]
+        self.assertTrue(isinstance(exception, ValueError))
+
+
+    @run_migrations(AuthorMigration, CommentMigration)
+    @patch('sys.stderr', new_callable=StringIO)
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_reading_from_snapshots(self, stdout, stderr):
+        import shutil, tempfile
+        directory = tempfile.mkdtemp()
+
+        Migrator.migrate(snapshot_dir=directory)
+        self.assertEqual(len(os.listdir(directory)), 4)
+        self.assertEqual(AuthorMigration.snapshot_dir, None)
+
+        with patch.object(BaseMigration, 'open_db_connection') as conn:
+            conn.side_effect = lambda: raise_(AssertionError())
+
+            # the change marker is taken from the snapshot as well
+            with patch.object(CommentMigration, 'change_marker', 'id'):
+                Migrator.migrate(commit=True, snapshot_dir=directory)
+            self.assertEqual(Comment.objects.count(), 20)
+            self.assertEqual(SyncMarker.objects.get().value, '20')
+            self.assertEqual(
+                Comment.objects.get(id=1).posted, datetime(2013, 9, 18, 23, 36, 56))
+            self.assertTrue("Migrating element 20/20" in stdout.getvalue())
+
+            # a changed query invalidates the snapshot
+            with patch.object(CommentMigration, 'query',
+                              CommentMigration.query.replace(';', ' LIMIT 5;')):
+                with self.assertRaises(AssertionError):
+                    Migrator.migrate(validate=True, snapshot_dir=directory)
+
+        shutil.rmtree(directory)
+
+
+    @run_migrations(AuthorMigration, CommentMigration)
+    @patch.multiple(CommentMigration, pushdown=True,
+                    hook_after_save=Migration.__dict__['hook_after_save'])
+    @patch('sys.stderr', new_callable=StringIO)
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_pushdown_into_the_target_db(self, stdout, stderr):
+        from django.db import connection
+        connection.cursor().execute(
+            "ATTACH DATABASE '%s' AS legacy" % self.db_path)
+
+        try:
+            Migrator.migrate(commit=True, only=['Author'])
+            Author.objects.filter(id=3).delete()
+
+            with patch.object(CommentMigration, 'open_db_connection') as conn:
+                with patch.dict(CommentMigration.column_description, {
+                    'author': is_a(Author, search_attr="id", fk=True)}):
+                    with self.assertRaises(ObjectDoesNotExist):
+                        Migrator.migrate(commit=True, only=['Comment'])
+
+                Migrator.migrate(commit=True, only=['Comment'])
+                self.assertFalse(conn.called)
+
+        finally:
+            connection.cursor().execute("DETACH DATABASE legacy")
+
+        self.assertEqual(Comment.objects.count(), 20)
+        self.assertEqual(Comment.objects.filter(author=None).count(), 6)
+        comment = Comment.objects.get(id=1)
+        self.assertEqual(comment.author_id, 4)
+        self.assertEqual(comment.posted, datetime(2013, 9, 18, 23, 36, 56))
+        self.assertTrue("Migrated 20 elements" in stdout.getvalue())
+
+        with patch.object(AuthorMigration, 'pushdown', True):
+            with self.assertRaises(ImproperlyConfigured):
+                AuthorMigration.check_migration()
+
+        # a callable default would be the same for all rows
+        with patch.object(CommentMigration, 'pushdown_fields',
+                          return_value=['id', 'message', 'author']), \
+                patch.object(Comment._meta.get_field('posted'), 'default',
+                             datetime.now):
+            with self.assertRaises(ImproperlyConfigured):
+                CommentMigration.compile_pushdown()
+
+
     @run_migrations(AuthorMigration)
     @patch.object(AuthorMigration, 'hook_update_existing')
     @patch.object(AuthorMigration, 'hook_after_all')
@@ -222,6 +613,65 @@ class MigrationTest(TransactionTestCase):
 
         self.assertEqual(AppliedMigration.objects.count(), 1)
 
+        run = MigrationRun.objects.get()
+        self.assertEqual(run.classname, str(AuthorMigration))
+        self.assertEqual(run.rows, 10)
+
+
+    @run_migrations(AuthorMigration)
+    @patch.object(AuthorMigration, 'batch_size', 4)
+    @patch.object(AuthorMigration, 'hook_after_save_batch')
+    @patch.object(AuthorMigration, 'hook_before_save_batch')
+    @patch.object(AuthorMigration, 'hook_before_transformation_batch')
+    @patch.object(AuthorMigration, 'hook_before_transformation')
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_batch_hooks(self, stdout, bef_trans, bef_trans_batch,
+                         bef_save_batch, aft_save_batch):
+        def transform(rows):
+            names = columnar(rows)['lastname']
+            for row, name in zip(rows, names):
+                row['lastname'] = str(name).upper()
+
+        def before_save(instances, rows):
+            for instance, row in zip(instances, rows):
+                instance.username = "author%d" % row['id']
+            return [ row['id'] != 5 for row in rows ]
+
+        bef_trans_batch.side_effect = transform
+        bef_save_batch.side_effect = before_save
+
+        Migrator.migrate(commit=True)
+
+        self.assertFalse(bef_trans.called)
+        self.assertEqual(bef_trans_batch.call_count, 3)
+        self.assertEqual(Author.objects.count(), 9)
+        self.assertTrue(all(author.lastname.isupper()
+                            for author in Author.objects.all()))
+
+        instances, rows = aft_save_batch.call_args_list[1][0]
+        self.assertEqual(len(instances), 3)
+        self.assertTrue(all(instance.pk for instance in instances))
+
+
+    @run_migrations(AuthorMigration)
+    @patch.object(AuthorMigration, 'hook_before_transformation_batch')
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_batch_hooks_for_single_rows(self, stdout, bef_trans_batch):
+        def transform(rows):
+            for row in rows:
+                row['lastname'] = row['lastname'].upper()
+
+        bef_trans_batch.side_effect = transform
+        Migrator.migrate(commit=True)
+
+        # the missing rows are created by the updating run one by one
+        Author.objects.filter(id__gt=8).delete()
+        Migrator.migrate(commit=True)
+
+        self.assertEqual(Author.objects.count(), 10)
+        self.assertTrue(all(author.lastname.isupper()
+                            for author in Author.objects.all()))
+
 
     @run_migrations(AuthorMigration)
     @patch.object(AuthorMigration, 'hook_after_save')
@@ -241,6 +691,280 @@ class MigrationTest(TransactionTestCase):
         self.assertEqual(Author.objects.count(), 10)
 
 
+    @run_migrations(AuthorMigration)
+    @patch.object(AuthorMigration, 'upsert_fields', ['lastname', 'email'])
+    @patch.object(AuthorMigration, 'hook_update_existing')
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_upserting_migrations(self, stdout, exist):
+        Migrator.migrate(commit=True)
+        lastname = Author.objects.get(id=3).lastname
+
+        Author.objects.filter(id=3).update(lastname="changed")
+        Author.objects.get(id=10).delete()
+
+        with patch.object(AuthorMigration, 'upsert_instances',
+                          wraps=AuthorMigration.upsert_instances) as upsert:
+            Migrator.migrate(commit=True)
+
+        self.assertEqual(upsert.call_count, 1)
+        self.assertFalse(exist.called)
+        self.assertEqual(Author.objects.count(), 10)
+        self.assertEqual(Author.objects.get(id=3).lastname, lastname)
+
+        with patch.object(AuthorMigration, 'allow_updates', False):
+            with self.assertRaises(ImproperlyConfigured):
+                AuthorMigration.check_migration()
+
+    @patch.object(AuthorMigration, 'upsert_fields', ['lastname'])
+    @patch('data_migration.migration.DJANGO_VERSION', (4, 1))
+    @patch.object(Author.objects, 'bulk_create')
+    def test_upserting_without_conflict_target(self, bulk_create):
+        from django.db import connection
+        authors = [ Author(id=1, lastname="a") ]
+
+        with patch.object(connection.features, 'supports_update_conflicts_with_target',
+                          False, create=True):
+            AuthorMigration.upsert_instances(authors)
+
+        bulk_create.assert_called_with(authors, update_conflicts=True,
+                                       update_fields=['lastname'])
+
+        with patch.object(connection.features, 'supports_update_conflicts_with_target',
+                          True, create=True):
+            AuthorMigration.upsert_instances(authors)
+
+        bulk_create.assert_called_with(authors, update_conflicts=True,
+                                       update_fields=['lastname'],
+                                       unique_fields=['id'])
+
+
+    @run_migrations(AuthorMigration)
+    @patch.object(AuthorMigration, 'full_refresh', True)
+    @patch.object(AuthorMigration, 'hook_update_existing')
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_full_refresh(self, stdout, exist):
+        Migrator.migrate(commit=True)
+        lastname = Author.objects.get(id=3).lastname
+
+        Author.objects.filter(id=3).update(lastname="changed")
+        Author.objects.create(id=99, username="stray")
+
+        with patch.object(Author.objects, 'bulk_create',
+                          wraps=Author.objects.bulk_create) as bulk_create:
+            Migrator.migrate(commit=True)
+
+        self.assertTrue(bulk_create.called)
+        self.assertFalse(exist.called)
+        self.assertEqual(Author.objects.count(), 10)
+        self.assertEqual(Author.objects.get(id=3).lastname, lastname)
+        self.assertEqual(AppliedMigration.objects.count(), 1)
+
+        # Author is referenced by Comment and Post. The connection itself is
+        # patched, because the proxy of Django 1.5 can't delete attributes
+        from django.db import connections, DEFAULT_DB_ALIAS
+        with patch.object(connections[DEFAULT_DB_ALIAS], 'vendor', 'mysql'):
+            with self.assertRaises(ImproperlyConfigured):
+                AuthorMigration.check_migration()
+
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_shared_source(self, stdout):
+        class AuthorSource(SharedSource):
+            query = """
+            SELECT id, Firstname as firstname, Lastname as lastname,
+                EmailAdress as email
+            FROM authors
+            """
+            batch_size = 3
+
+            @classmethod
+            def open_db_connection(self):
+                return BaseMigration.open_db_connection()
+
+        class WelcomeMigration(BaseMigration):
+            shared_source = AuthorSource
+            model = Comment
+            depends_on = [ Author ]
+            column_description = dict(
+                [ (column, is_a(exclude=True))
+                    for column in ('id', 'firstname', 'lastname', 'email') ] +
+                [ ('author', is_a(Author, search_attr="id", fk=True)) ])
+
+            @classmethod
+            def hook_before_transformation(self, row):
+                row['author'] = row['id']
+                row['message'] = "Welcome %s" % row['firstname']
+
+        class SharedAuthorMigration(AuthorMigration):
+            shared_source = AuthorSource
+            query = None
+            change_marker = "id"
+
+        @run_migrations(WelcomeMigration, SharedAuthorMigration, PostMigration)
+        def migrate():
+            self.assertEqual(Migrator.sorted_migrations()[:2],
+                             [SharedAuthorMigration, WelcomeMigration])
+
+            with patch.object(AuthorSource, 'open_db_connection',
+                              wraps=AuthorSource.open_db_connection) as connect, \
+                    patch.object(WelcomeMigration, 'buildup_relation_cache',
+                        wraps=WelcomeMigration.buildup_relation_cache) as buildup:
+                Migrator.migrate(commit=True, only=['Author', 'Comment'])
+
+            self.assertEqual(connect.call_count, 1)
+            # the authors of later batches are added to the cache
+            self.assertEqual(buildup.call_count, 1)
+
+        migrate()
+        self.assertEqual(Author.objects.count(), 10)
+        self.assertEqual(Comment.objects.count(), 10)
+        for comment in Comment.objects.select_related('author'):
+            self.assertEqual(comment.message,
+                             "Welcome %s" % comment.author.firstname)
+        self.assertEqual(AppliedMigration.objects.count(), 2)
+        self.assertEqual(SyncMarker.objects.get().value, '10')
+
+
+    @run_migrations(AuthorMigration, CommentMigration)
+    @patch.dict(CommentMigration.column_description, {
+        'author': is_a(Author, search_attr="id", fk=True) })
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_extending_incomplete_caches(self, stdout):
+        Migrator.migrate(commit=True, only=['Author'])
+        CommentMigration.buildup_relation_cache(Author, 'id', 1, False)
+        Author.objects.create(id=11, username="new")
+
+        with patch.object(CommentMigration, 'incomplete_caches', [ Author ]):
+            CommentMigration.extend_incomplete_caches([ { 'author': 11 } ])
+
+        cache = CommentMigration.relation_cache[Author]
+        self.assertEqual(len(cache), 11)
+        self.assertEqual(cache[11].username, "new")
+
+
+    @run_migrations(AuthorMigration)
+    @patch.multiple(AuthorMigration, change_marker='id', follow_batch_size=2)
+    @patch.object(AuthorMigration, 'hook_update_existing')
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_following_changes(self, stdout, update_existing):
+        Migrator.migrate(commit=True)
+        self.assertEqual(SyncMarker.objects.get().value, '10')
+
+        # pretend the last rows have been changed after the run
+        Author.objects.filter(id__gt=8).delete()
+        SyncMarker.objects.update(value='7')
+
+        # the rows with the stored marker are applied again, but only once
+        applied = Migrator.follow(interval=0, cycles=2)
+
+        self.assertEqual(applied, 4)
+        self.assertEqual(Author.objects.count(), 10)
+        self.assertEqual(update_existing.call_count, 2)
+        self.assertEqual(SyncMarker.objects.get().value, '10')
+        self.assertEqual(json.loads(SyncMarker.objects.get().keys), ['10'])
+        self.assertIn("4 rows applied up to 10", stdout.getvalue())
+
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_following_changes_in_batches(self, stdout):
+        conn = sqlite3.connect(self.db_path)
+        conn.executescript("""
+            CREATE TABLE nodes (id INTEGER PRIMARY KEY, parent INTEGER);
+            INSERT INTO nodes VALUES (1, NULL);
+            INSERT INTO nodes VALUES (2, 1);
+        """)
+
+        class NodeMigration(BaseMigration):
+            query = "SELECT id, parent FROM nodes"
+            model = Node
+            allow_updates = True
+            search_attr = "id"
+            change_marker = "id"
+            follow_batch_size = 1
+            column_description = {
+                'parent': is_a(Node, search_attr="id", fk=True, deferred=True) }
+
+        @run_migrations(NodeMigration)
+        def follow():
+            Migrator.migrate(commit=True)
+
+            conn.executescript("""
+                INSERT INTO nodes VALUES (3, 2);
+                INSERT INTO nodes VALUES (4, 3);
+            """)
+
+            # only the instances of each batch are looked up
+            with patch.object(NodeMigration, 'buildup_relation_cache') as buildup:
+                Migrator.follow(interval=0, cycles=1)
+                self.assertFalse(buildup.called)
+
+        follow()
+        conn.close()
+
+        self.assertEqual(dict(Node.objects.values_list('id', 'parent_id')),
+                         { 1: None, 2: 1, 3: 2, 4: 3 })
+
+
+    @run_migrations(AuthorMigration)
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_verifying_migrated_data(self, stdout):
+        Migrator.migrate(commit=True)
+
+        result, = Migrator.verify(chunk_size=4)
+        self.assertEqual(result['source'], 10)
+        self.assertEqual(result['target'], 10)
+        self.assertEqual(result['columns'], ['id', 'firstname', 'lastname', 'email'])
+        self.assertEqual(result['differences'], [])
+
+        Author.objects.filter(id=6).update(lastname="changed")
+        Author.objects.create(id=99, username="stray")
+
+        result, = Migrator.verify(chunk_size=4)
+        self.assertEqual(result['differences'],
+                         [(5, 8, 4, 4), (10, None, 0, 1)])
+        self.assertIn("id 5..8: 4 source rows, 4 target rows", stdout.getvalue())
+
+
+    @run_migrations(AuthorMigration, CommentMigration)
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_verifying_aware_datetimes(self, stdout):
+        with self.settings(USE_TZ=True):
+            Migrator.migrate(commit=True)
+
+            # the naive legacy datetimes equal the aware ones of the model
+            with patch.object(CommentMigration, 'search_attr', 'id'):
+                result = CommentMigration.verify(chunk_size=8)
+            self.assertIn('posted', result['columns'])
+            self.assertEqual(result['differences'], [])
+
+
+    @run_migrations(AuthorMigration)
+    @patch.object(AuthorMigration, 'hook_after_muted_signals')
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_muting_signals(self, stdout, after_muted):
+        from django.db.models.signals import post_save
+        saved = []
+        receiver = lambda sender, instance, **kwargs: saved.append(instance)
+        post_save.connect(receiver, sender=Author)
+
+        try:
+            Migrator.migrate(commit=True, mute_signals=True)
+
+            self.assertEqual(Author.objects.count(), 10)
+            self.assertEqual(saved, [])
+            self.assertEqual(after_muted.call_count, 1)
+            self.assertEqual(AuthorMigration.mute_signals, None)
+
+            Author.objects.create(username="new")
+            self.assertEqual(len(saved), 1)
+
+            with patch.object(AuthorMigration, 'mute_signals', True):
+                from django.db.models.signals import post_init
+                self.assertNotIn(post_init, AuthorMigration.muted_signals())
+        finally:
+            post_save.disconnect(receiver, sender=Author)
+
+
     @run_migrations(AuthorMigration)
     @patch.object(AuthorMigration, 'hook_row_count')
     @patch('sys.stdout', new_callable=StringIO)
@@ -248,7 +972,11 @@ class MigrationTest(TransactionTestCase):
     def test_row_count_hook(self, err, out, hook):
         hook.side_effect = lambda conn, cursor: 55555
 
-        Migrator.migrate(commit=True)
+        # the hook replaces the count query
+        with patch.object(AuthorMigration, 'count_rows') as count_rows:
+            Migrator.migrate(commit=True)
+            self.assertFalse(count_rows.called)
+
         self.assertTrue(hook.called)
 
         connection, cursor = hook.call_args[0]
@@ -288,6 +1016,123 @@ class MigrationTest(TransactionTestCase):
         self.assertTrue(isinstance(row, dict))
 
 
+    @run_migrations(AuthorMigration, CommentMigration)
+    @patch('sys.stderr', new_callable=StringIO)
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_quarantine_and_replay_failing_rows(self, out, err):
+        def side_effect(instance, row):
+            if row['id'] % 2 == 0:
+                raise ValueError("even")
+
+        with patch.object(CommentMigration, 'hook_before_save') as hook:
+            hook.side_effect = side_effect
+            Migrator.migrate(commit=True, max_failures=10)
+
+        self.assertEqual(CommentMigration.max_failures, None)
+        self.assertEqual(Comment.objects.count(), 10)
+        self.assertEqual(QuarantinedRow.objects.count(), 10)
+
+        entry = QuarantinedRow.objects.order_by('pk')[0]
+        self.assertEqual(entry.classname, str(CommentMigration))
+        self.assertEqual(entry.exception, "ValueError: even")
+        self.assertEqual(json.loads(entry.row)['id'], 2)
+
+        failed = Migrator.replay_quarantine(commit=True)
+        self.assertEqual(failed, 0)
+        self.assertEqual(Comment.objects.count(), 20)
+        self.assertEqual(QuarantinedRow.objects.count(), 0)
+
+
+    @run_migrations(AuthorMigration)
+    @patch.multiple(AuthorMigration, bulk_insert=True, batch_size=4)
+    @patch.object(AuthorMigration, 'hook_before_save')
+    @patch('sys.stderr', new_callable=StringIO)
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_bulk_insert_isolates_failing_rows(self, out, err, hook):
+        def side_effect(instance, row):
+            instance.username = "dup" if row['id'] in (3, 7) else row['id']
+        hook.side_effect = side_effect
+
+        with patch.object(Author.objects, 'bulk_create',
+                          wraps=Author.objects.bulk_create) as bulk_create:
+            Migrator.migrate(commit=True, max_failures=1)
+
+        self.assertEqual(Author.objects.count(), 9)
+        self.assertEqual(json.loads(QuarantinedRow.objects.get().row)['id'], 7)
+        # 3 batches, the failing one is split into 2, 1, 1 rows
+        self.assertEqual(bulk_create.call_count, 7)
+
+        with patch.object(PostMigration, 'bulk_insert', True):
+            with self.assertRaises(ImproperlyConfigured):
+                PostMigration.check_migration()
+
+        # only errors of the database are isolated
+        Author.objects.all().delete()
+        AppliedMigration.objects.all().delete()
+        with patch.object(Author.objects, 'bulk_create', side_effect=TypeError):
+            with self.assertRaises(TypeError):
+                Migrator.migrate(commit=True)
+
+        # deferred relations require the primary keys after writing
+        class NodeMigration(BaseMigration):
+            query = "SELECT id, parent FROM nodes"
+            model = Node
+            bulk_insert = True
+            column_description = {
+                'parent': is_a(Node, search_attr="id", fk=True, deferred=True) }
+
+        with patch.object(NodeMigration, 'bulk_write_sets_pks', return_value=False):
+            with self.assertRaises(ImproperlyConfigured):
+                NodeMigration.check_migration()
+
+        with patch.object(NodeMigration, 'search_attr', 'id'):
+            NodeMigration.check_migration()
+
+
+    @run_migrations(AuthorMigration, CommentMigration)
+    @patch.object(CommentMigration, 'hook_before_save')
+    @patch('sys.stderr', new_callable=StringIO)
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_failure_threshold_aborts_the_run(self, out, err, hook):
+        hook.side_effect = lambda instance, row: raise_(ValueError())
+
+        with self.assertRaises(FailureThresholdExceeded):
+            Migrator.migrate(commit=True, max_failures=5)
+
+        self.assertEqual(Author.objects.count(), 0)
+        # the failing rows are kept, although the run is rolled back
+        self.assertEqual(QuarantinedRow.objects.count(), 6)
+
+
+    @run_migrations(AuthorMigration)
+    @patch.multiple(AuthorMigration, read_ahead=2, transform_in_reader=True,
+                    batch_size=4)
+    @patch.object(AuthorMigration, 'hook_before_transformation')
+    @patch('sys.stderr', new_callable=StringIO)
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_quarantine_keeps_untransformed_rows(self, out, err, transform):
+        def side_effect(row):
+            row['lastname'] = "[%s]" % row['lastname']
+        transform.side_effect = side_effect
+
+        before_save = AuthorMigration.hook_before_save
+        def failing(instance, row):
+            if row['id'] == 3:
+                raise ValueError("three")
+            before_save(instance, row)
+
+        with patch.object(AuthorMigration, 'hook_before_save',
+                          side_effect=failing):
+            Migrator.migrate(commit=True, max_failures=1)
+
+        self.assertFalse(json.loads(
+            QuarantinedRow.objects.get().row)['lastname'].startswith("["))
+
+        Migrator.replay_quarantine(commit=True)
+        lastname = Author.objects.get(id=3).lastname
+        self.assertTrue(lastname.startswith("[") and not lastname.startswith("[["))
+
+
     @run_migrations(AuthorMigration, CommentMigration)
     @patch('sys.stdout', new_callable=StringIO)
     @patch('sys.stderr', new_callable=StringIO)
@@ -319,6 +1164,160 @@ class MigrationTest(TransactionTestCase):
             clean.assert_called
 
 
+    @run_migrations(AuthorMigration, CommentMigration)
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('sys.stderr', new_callable=StringIO)
+    def test_memory_tracking(self, err, out):
+        import tempfile
+        report = tempfile.mktemp()
+
+        with patch.dict(CommentMigration.column_description, {
+            'author': is_a(Author, search_attr="id", fk=True, prefetch=True)}):
+            Migrator.migrate(commit=True, memory_report=report)
+
+        with open(report) as f:
+            usage = json.load(f)
+        os.unlink(report)
+
+        comments = usage[str(CommentMigration)]
+        self.assertEqual(comments['relation_caches']['Author']['entries'], 10)
+        self.assertTrue(comments['relation_caches']['Author']['bytes'] > 0)
+        self.assertTrue(comments['peak_rss'] > 0)
+        self.assertTrue("relation cache Author: 10 entries" in out.getvalue())
+        self.assertFalse(CommentMigration.track_memory)
+
+        # the tracker is stopped if the migration fails as well
+        AppliedMigration.objects.all().delete()
+        with patch.object(AuthorMigration, 'write_rows', side_effect=ValueError), \
+                patch.object(MemoryTracker, 'stop') as stop:
+            with self.assertRaises(ValueError):
+                Migrator.migrate(commit=True, memory_report=report)
+            self.assertEqual(stop.call_count, 1)
+
+
+    @run_migrations(AuthorMigration, CommentMigration)
+    @patch.object(CommentMigration, 'hook_before_save',
+                  side_effect=lambda instance, row: row['id'] != 1)
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_exporting_metrics(self, stdout, before_save):
+        import tempfile
+        textfile, jsonl = tempfile.mktemp(), tempfile.mktemp()
+
+        Migrator.migrate(commit=True, metrics_interval=0, metrics=[
+            PrometheusTextfileSink(textfile), JsonLinesSink(jsonl)])
+
+        with open(textfile) as f:
+            text = f.read()
+        with open(jsonl) as f:
+            lines = [ json.loads(line) for line in f ]
+        os.unlink(textfile)
+        os.unlink(jsonl)
+
+        counters = lines[-1]['counters']
+        self.assertEqual(counters['rows_read'][str(AuthorMigration)], 10)
+        self.assertEqual(counters['rows_written'][str(AuthorMigration)], 10)
+        self.assertEqual(counters['rows_written'][str(CommentMigration)], 19)
+        self.assertEqual(counters['rows_skipped'][str(CommentMigration)], 1)
+        self.assertEqual(counters['rows_failed'][str(CommentMigration)], 0)
+        self.assertIn(str(CommentMigration),
+                      lines[-1]['gauges']['batch_latency_seconds'])
+        self.assertIn(str(AuthorMigration),
+                      [ line['current_migration'] for line in lines ])
+        self.assertIn('data_migration_rows_written_total{migration="%s"} 19'
+                      % CommentMigration, text)
+        self.assertIsNone(Migration.metrics)
+
+
+    @run_migrations(AuthorMigration, CommentMigration, PostMigration)
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('sys.stderr', new_callable=StringIO)
+    def test_counting_queries_per_phase(self, err, out):
+        # saving an existing instance selects it first on Django 1.5, which
+        # takes the hook of CommentMigration to 5 queries per row
+        saving = 2 if DJANGO_VERSION < (1, 6) else 1
+        with patch.object(CommentMigration, 'max_queries_per_row', 3 + saving):
+            Migrator.migrate(commit=True, count_queries=True)
+
+        authors = Migration.query_counts[str(AuthorMigration)]
+        self.assertEqual(authors['rows'], 10)
+        self.assertEqual(authors['phases'], { 'save': 20 })
+
+        posts = Migration.query_counts[str(PostMigration)]
+        self.assertEqual(posts['phases']['lookup'], 30)
+        self.assertTrue(posts['phases']['m2m'] > 0)
+        self.assertEqual(posts['phases']['hooks'], 10 * saving)
+
+        self.assertTrue("%s has issued" % PostMigration in err.getvalue())
+        self.assertTrue("relation lookups" in err.getvalue())
+        self.assertFalse("%s has issued" % CommentMigration in err.getvalue())
+        self.assertTrue("Queries on the Django database" in out.getvalue())
+
+    def test_query_phases_of_other_threads_are_ignored(self):
+        from django.db import connection
+        counter = QueryCounter(connection).start()
+
+        def transform():
+            with counter.phase('hooks'):
+                return counter.current
+
+        with counter.phase('save'):
+            self.assertEqual(BackgroundCall(transform).result(), 'save')
+            self.assertEqual(counter.current, 'save')
+
+        counter.stop()
+        self.assertEqual(counter.current, 'other')
+
+
+    @run_migrations(AuthorMigration, CommentMigration)
+    @patch.object(AuthorMigration, 'depends_on', [Comment])
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('sys.stderr', new_callable=StringIO)
+    def test_deferred_relations(self, err, out):
+        conn = sqlite3.connect(self.db_path)
+        expected = dict(conn.execute(
+            "SELECT c.id, a.id FROM comments c JOIN authors a ON a.id = c.Author"))
+        conn.close()
+
+        with patch.dict(CommentMigration.column_description, {
+            'author': is_a(Author, search_attr="id", fk=True,
+                           skip_missing=True, deferred=True)}), \
+                patch.object(CommentMigration, 'batch_size', 4):
+
+            # the cycle is broken by the deferred relation
+            self.assertEqual(Migrator.sorted_migrations(),
+                             [CommentMigration, AuthorMigration])
+
+            Migrator.migrate(commit=True)
+
+        self.assertEqual(Comment.objects.count(), 20)
+        self.assertEqual(dict(Comment.objects.filter(author__isnull=False)
+                                .values_list('id', 'author_id')), expected)
+        self.assertEqual(Migration.deferred_relations, {})
+
+
+    @run_migrations(AuthorMigration, CommentMigration, PostMigration)
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('sys.stderr', new_callable=StringIO)
+    def test_m2m_pairs_query(self, err, out):
+        through = Post.comments.through
+
+        with patch.dict(PostMigration.column_description, {
+            'comments': is_a(Comment, search_attr="id", m2m=True,
+                pairs_query="SELECT Post, id FROM comments ORDER BY id")}), \
+                patch.object(PostMigration, 'batch_size', 8), \
+                patch.object(through.objects, 'bulk_create',
+                             wraps=through.objects.bulk_create) as bulk_create:
+
+            Migrator.migrate(commit=True)
+
+        self.assertEqual(Post.objects.get(id=9).comments.count(), 3)
+        self.assertEqual(through.objects.count(), 20)
+        self.assertEqual(bulk_create.call_count, 3)
+
+        with self.assertRaises(ImproperlyConfigured):
+            is_a(Comment, search_attr="id", fk=True, pairs_query="SELECT 1")
+
+
     @run_migrations(AuthorMigration, CommentMigration)
     @patch('sys.stdout', new_callable=StringIO)
     @patch('sys.stderr', new_callable=StringIO)
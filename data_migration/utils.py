@@ -1,4 +1,16 @@
 # -*- coding: utf-8 -*-
+from future.moves.queue import Queue, Full
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import reset_queries
+
+from contextlib import contextmanager
+from future.builtins import str
+
+import base64
+import hashlib
+import json
+import sys
+import threading
 
 def itersubclasses(cls, _seen=None):
     """
@@ -39,3 +51,454 @@ def itersubclasses(cls, _seen=None):
             yield sub
             for sub in itersubclasses(sub, _seen):
                 yield sub
+
+
+def format_duration(seconds):
+    """
+    format_duration(seconds)
+
+    Formats the supplied number of seconds in a human readable way.
+
+    >>> format_duration(3723.4)
+    '1h 02m 03s'
+    >>> format_duration(None)
+    'unknown'
+    """
+
+    if seconds is None:
+        return 'unknown'
+
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%dh %02dm %02ds' % (hours, minutes, seconds)
+
+
+class _Failure(object):
+    """wraps an exception raised in a background thread"""
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def iterate_in_background(iterable, depth):
+    """
+    iterate_in_background(iterable, depth)
+
+    Generator over the elements of `iterable`, which are produced by
+    a background thread. At most `depth` elements are buffered, so the memory
+    usage stays bounded. Exceptions raised while producing an element are
+    reraised in the consuming thread.
+
+    >>> list(iterate_in_background(range(5), 2))
+    [0, 1, 2, 3, 4]
+    """
+
+    queue = Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        # do not block forever if the consumer has stopped iterating
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(_Failure(e))
+        else:
+            put(end)
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item = queue.get()
+
+            if item is end:
+                break
+            elif isinstance(item, _Failure):
+                raise item.exception
+
+            yield item
+    finally:
+        stop.set()
+
+
+class BackgroundCall(object):
+    """
+    BackgroundCall(function, *args)
+
+    Calls `function` with the supplied arguments in a background thread.
+
+    >>> call = BackgroundCall(sum, [1, 2, 3])
+    >>> call.result()
+    6
+    """
+
+    def __init__(self, function, *args):
+        self.value = None
+        self.exception = None
+
+        self.thread = threading.Thread(target=self.run, args=(function, args))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, function, args):
+        try:
+            self.value = function(*args)
+        except Exception as e:
+            self.exception = e
+
+    def done(self):
+        """returns True if the function has returned or raised"""
+        return not self.thread.is_alive()
+
+    def wait(self):
+        """waits for the function to return or raise"""
+        self.thread.join()
+
+    def result(self):
+        """waits for the function and returns its result or reraises"""
+        self.thread.join()
+
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+
+def columnar(rows):
+    """
+    columnar(rows)
+
+    Returns the values of the supplied rows (dicts) as a dict of columns,
+    which is useful in the batch hooks of a migration. The columns are NumPy
+    arrays if NumPy is installed and lists otherwise.
+
+    >>> list(columnar([{'a': 1}, {'a': 2}])['a'])
+    [1, 2]
+    """
+
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    names = list(rows[0]) if rows else []
+    columns = dict( (name, [ row[name] for row in rows ]) for name in names )
+
+    if numpy is not None:
+        columns = dict( (name, numpy.array(values))
+                            for name, values in columns.items() )
+    return columns
+
+
+def peak_rss():
+    """
+    peak_rss()
+
+    Returns the peak resident set size of the process in bytes or None, if it
+    can not be determined on this platform.
+    """
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, OS X bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def approximate_size(mapping):
+    """
+    approximate_size(mapping)
+
+    Returns the approximate number of bytes used by the supplied dict, its
+    keys and values and the attributes of the values (e.g. model instances).
+    Objects, which are shared between the values, are counted multiple times.
+
+    >>> approximate_size({}) > 0
+    True
+    """
+
+    size = sys.getsizeof(mapping)
+
+    for key, value in mapping.items():
+        size += sys.getsizeof(key) + sys.getsizeof(value)
+
+        attributes = getattr(value, '__dict__', None)
+        if attributes is not None:
+            size += sys.getsizeof(attributes) + sum(
+                sys.getsizeof(attr) for attr in attributes.values())
+
+    return size
+
+
+class MemoryTracker(object):
+    """
+    MemoryTracker()
+
+    Measures the memory usage of the process from its creation until `stop`
+    is called. The measurements of `tracemalloc` are only available on
+    Python 3.
+
+    >>> sorted(MemoryTracker().stop())
+    ['peak_rss', 'rss_growth', 'traced_delta', 'traced_peak']
+    """
+
+    def __init__(self):
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+
+        self.tracemalloc = tracemalloc
+        self.started_tracing = False
+        self.traced = None
+
+        if tracemalloc is not None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            elif hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+
+            self.traced = tracemalloc.get_traced_memory()[0]
+
+        self.rss = peak_rss()
+
+    def stop(self):
+        """returns a dict with the measured values in bytes"""
+        usage = { 'peak_rss': peak_rss(), 'rss_growth': None,
+                  'traced_delta': None, 'traced_peak': None }
+
+        if self.rss is not None:
+            usage['rss_growth'] = usage['peak_rss'] - self.rss
+
+        if self.tracemalloc is not None:
+            current, peak = self.tracemalloc.get_traced_memory()
+            usage['traced_delta'] = current - self.traced
+            usage['traced_peak'] = peak - self.traced
+
+            if self.started_tracing:
+                self.tracemalloc.stop()
+
+        return usage
+
+
+class QueryCounter(object):
+    """
+    QueryCounter(connection)
+
+    Counts the queries issued on a Django database connection between `start`
+    and `stop`, broken down by phases. It uses `connection.execute_wrapper`
+    if it is available (Django >= 2.0) and the query log of the debug cursor
+    otherwise.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.counts = {}
+        self.current = 'other'
+        self.wrapper = None
+        self.debug_flag = None
+        self.previous_debug = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.current_thread()
+        if hasattr(self.connection, 'execute_wrapper'):
+            self.wrapper = self.connection.execute_wrapper(self)
+            self.wrapper.__enter__()
+            return self
+
+        # Django < 1.8 calls it use_debug_cursor
+        self.debug_flag = 'force_debug_cursor' \
+            if hasattr(self.connection, 'force_debug_cursor') else 'use_debug_cursor'
+        self.previous_debug = getattr(self.connection, self.debug_flag)
+        setattr(self.connection, self.debug_flag, True)
+        reset_queries()
+        return self
+
+    def stop(self):
+        if self.wrapper is not None:
+            self.wrapper.__exit__(None, None, None)
+            self.wrapper = None
+        else:
+            self.flush()
+            setattr(self.connection, self.debug_flag, self.previous_debug)
+
+    def total(self):
+        return sum(self.counts.values())
+
+    @contextmanager
+    def phase(self, name):
+        """
+        attributes the queries issued in this context to `name`. Other
+        threads (e.g. reading ahead) use their own connection and must not
+        change the current phase, so they are ignored.
+        """
+        if threading.current_thread() is not self.thread:
+            yield
+            return
+
+        previous = self.current
+        self.flush()
+        self.current = name
+        try:
+            yield
+        finally:
+            self.flush()
+            self.current = previous
+
+    def count(self, number):
+        if number:
+            self.counts[self.current] = self.counts.get(self.current, 0) + number
+
+    def flush(self):
+        # the query log is emptied after counting, so it doesn't grow and
+        # doesn't hit its size limit
+        if self.wrapper is None and self.debug_flag is not None:
+            self.count(len(self.connection.queries))
+            reset_queries()
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count(1)
+        return execute(sql, params, many, context)
+
+
+def checksum(rows):
+    """
+    checksum(rows)
+
+    Returns a checksum of the supplied rows (sequences of values), which
+    doesn't depend on the order of the rows or on the type of the values,
+    e.g. 1 and '1' are equal.
+
+    >>> checksum([(1, 'a'), (2, None)]) == checksum([('2', None), ('1', 'a')])
+    True
+    """
+
+    def normalize(value):
+        if value is None:
+            return '\x00'
+        if isinstance(value, bool):
+            return str(int(value))
+        if isinstance(value, bytes):
+            return value.decode('utf-8', 'replace')
+        return str(value)
+
+    lines = sorted('\x1f'.join(normalize(value) for value in row)
+                        for row in rows)
+    return hashlib.sha1('\x1e'.join(lines).encode('utf-8')).hexdigest()
+
+
+try:
+    binary_types = (bytes, bytearray, memoryview, buffer)
+except NameError:
+    binary_types = (bytes, bytearray, memoryview)
+
+
+class RowEncoder(DjangoJSONEncoder):
+    """
+    JSON encoder for rows returned by a query, which falls back to the text
+    representation for types that are not supported otherwise. Binary values
+    are encoded as base64, see `decode_row`.
+    """
+
+    def default(self, o):
+        if isinstance(o, binary_types):
+            return { '__bytes__': base64.b64encode(bytes(o)).decode('ascii') }
+
+        try:
+            return super(RowEncoder, self).default(o)
+        except TypeError:
+            return repr(o)
+
+
+def decode_row(text):
+    """
+    decode_row(text)
+
+    Decodes a row, which has been encoded with `RowEncoder`.
+
+    >>> decode_row(json.dumps({'a': b'\\x00'}, cls=RowEncoder))['a'] == b'\\x00'
+    True
+    """
+    def binary(mapping):
+        if list(mapping) == ['__bytes__']:
+            return base64.b64decode(mapping['__bytes__'])
+        return mapping
+
+    return json.loads(text, object_hook=binary)
+
+
+@contextmanager
+def class_attributes(classes, **attributes):
+    """
+    class_attributes(classes, **attributes)
+
+    Context manager that sets the supplied attributes on each of the classes
+    and restores the previous state afterwards.
+    """
+
+    missing = object()
+    previous = [ (cls, name, cls.__dict__.get(name, missing))
+                    for cls in classes for name in attributes ]
+
+    for cls in classes:
+        for name, value in attributes.items():
+            setattr(cls, name, value)
+
+    try:
+        yield
+    finally:
+        for cls, name, value in previous:
+            if value is missing:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, value)
+
+
+@contextmanager
+def muted_signals(signals):
+    """
+    muted_signals(signals)
+
+    Context manager that disconnects all receivers of the supplied signals
+    and connects them again afterwards. Receivers connected in the meantime
+    are dropped.
+    """
+
+    def clear_cache(signal):
+        # the cache has been added in Django 1.6
+        cache = getattr(signal, 'sender_receivers_cache', None)
+        if cache is not None:
+            cache.clear()
+
+    previous = [ (signal, signal.receivers) for signal in signals ]
+
+    for signal in signals:
+        with signal.lock:
+            signal.receivers = []
+            clear_cache(signal)
+
+    try:
+        yield
+    finally:
+        for signal, receivers in previous:
+            with signal.lock:
+                signal.receivers = receivers
+                clear_cache(signal)